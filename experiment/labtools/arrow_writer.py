@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+labtools.arrow_writer
+
+Write trial data as typed columns in an Arrow IPC stream.
+
+Each call to write_rows appends one record batch, e.g., one block of
+trials, so the file can be read up to the last complete block even if a
+session is cut short. Columns of repeated strings are dictionary encoded.
+Read the file with pyarrow.ipc.open_stream in python or
+arrow::read_ipc_stream in R.
+
+Requires pyarrow, which is optional. Use ArrowWriter.open_if_available
+to skip writing the file when pyarrow isn't installed.
+"""
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+def _arrow_types():
+    return {
+        'string': pyarrow.string(),
+        'category': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        'int': pyarrow.int64(),
+        'float': pyarrow.float64(),
+    }
+
+def _to_array(values, column_type):
+    """ Convert a list of values to an arrow array of the column type.
+
+    Empty strings in numeric columns, e.g., runtime columns that weren't
+    set, become nulls.
+    """
+    if column_type in ('string', 'category'):
+        array = pyarrow.array([None if v is None else str(v) for v in values],
+                              type=pyarrow.string())
+        if column_type == 'category':
+            array = array.dictionary_encode()
+        return array
+    values = [None if v is None or v == '' else v for v in values]
+    return pyarrow.array(values, type=_arrow_types()[column_type])
+
+class ArrowWriter(object):
+    """ Append rows of a labtools.trial_list.TrialList to an Arrow file. """
+    def __init__(self, filename, column_types):
+        """
+        Parameters
+        ----------
+        filename: Path to the file to write.
+        column_types: OrderedDict of column names to 'string', 'category',
+            'int', or 'float'. Only these columns are written, in this order.
+        """
+        if pyarrow is None:
+            raise ImportError('writing arrow files requires pyarrow')
+        arrow_types = _arrow_types()
+        self.column_types = column_types
+        self.schema = pyarrow.schema([
+            pyarrow.field(name, arrow_types[column_type])
+            for name, column_type in column_types.items()
+        ])
+        self._sink = pyarrow.OSFile(str(filename), 'wb')
+        self._writer = pyarrow.RecordBatchStreamWriter(self._sink, self.schema)
+        self.closed = False
+
+    @classmethod
+    def open_if_available(cls, filename, column_types):
+        """ Open a writer, or return None if pyarrow isn't installed. """
+        if pyarrow is None:
+            return None
+        return cls(filename, column_types)
+
+    def write_rows(self, trial_list, start=0, stop=None):
+        """ Append the rows from start to stop as one record batch. """
+        arrays = [_to_array(trial_list.column(name, start, stop), column_type)
+                  for name, column_type in self.column_types.items()]
+        batch = pyarrow.RecordBatch.from_arrays(arrays,
+                                                list(self.column_types))
+        self._writer.write_batch(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.close()
+        self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
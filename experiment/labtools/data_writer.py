@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+labtools.data_writer
+
+Write data files from a background thread so trials never wait on the disk.
+"""
+import atexit
+import os
+import threading
+import warnings
+
+from queue import Queue, Full, Empty
+
+_STOP = object()
+
+class AsyncWriter(object):
+    """ A file-like object that writes from a background thread.
+
+    Writes are added to a bounded queue and return immediately. The worker
+    thread drains everything in the queue, writes it in one batch, and
+    fsyncs the file after every `fsync_every` items. If the queue fills up
+    because the disk can't keep up, a warning is issued and the write waits
+    for space.
+
+    Everything written is flushed to disk when the writer is closed, when
+    a `with` block exits (including on an exception), or when the
+    interpreter exits.
+    """
+    def __init__(self, filename, mode='w', maxsize=100, fsync_every=10):
+        """
+        Parameters
+        ----------
+        filename: Path to the file to write.
+        mode: Mode for opening the file. Use 'wb' for binary data.
+        maxsize: Number of writes that can be waiting in the queue.
+        fsync_every: Number of writes between calls to os.fsync.
+        """
+        self._file = open(str(filename), mode)
+        self._queue = Queue(maxsize)
+        self.fsync_every = fsync_every
+        self.closed = False
+        self.error = None
+
+        self._thread = threading.Thread(target=self._run, name='AsyncWriter')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, data):
+        """ Queue a string (or bytes) to be written as is. """
+        self._put(data)
+
+    def flush(self):
+        """ Writes are flushed by the worker, so there's nothing to do. """
+        self._raise_error()
+
+    def close(self):
+        """ Write everything in the queue, fsync, and close the file. """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._file.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _put(self, item):
+        self._raise_error()
+        if self.closed:
+            raise ValueError('write to closed AsyncWriter')
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            warnings.warn('%s is %d writes behind, waiting for the disk' %
+                          (self._file.name, self._queue.maxsize))
+            self._queue.put(item)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        n_unsynced = 0
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            if batch[-1] is _STOP:
+                batch.pop()
+                stopping = True
+
+            try:
+                for item in batch:
+                    self._file.write(item)
+                self._file.flush()
+
+                n_unsynced += len(batch)
+                if stopping or n_unsynced >= self.fsync_every:
+                    os.fsync(self._file.fileno())
+                    n_unsynced = 0
+            except Exception as error:
+                # Report the error on the main thread at the next write
+                self.error = error
@@ -1,7 +1,121 @@
 #!/usr/bin/env python
+import math
+import random
+
+import numpy as np
 from unipath import Path
-from psychopy.visual import ImageStim
-from random import shuffle, choice
+from PIL import Image
+try:
+    from psychopy.visual import ImageStim, GratingStim, ElementArrayStim
+except ImportError:
+    # Masks can still be drawn with stimuli from another backend
+    ImageStim = GratingStim = ElementArrayStim = None
+
+from labtools.masknoise import generate_noise_masks
+from labtools.rng import PythonRandom
+
+MASK_DIR = Path(Path(__file__).absolute().parent, 'dynamicmask')
+
+# Atlases are shared by every DynamicMask in the process
+_atlases = {}
+
+def _next_power_of_two(n):
+    return 1 << int(math.ceil(math.log(n, 2))) if n > 1 else 1
+
+def load_atlas(pattern='*.png'):
+    """ Get the atlas for the mask images matching pattern.
+
+    The images are only decoded the first time an atlas is requested.
+    """
+    if pattern not in _atlases:
+        pngs = MASK_DIR.listdir(pattern=pattern)
+        frames = [Image.open(str(png)).convert('RGB') for png in pngs]
+        _atlases[pattern] = MaskAtlas(frames)
+    return _atlases[pattern]
+
+def load_noise_atlas(n_frames, size=128, slope=1.0, seed=None, cache_dir=None):
+    """ Get an atlas of generated noise masks.
+
+    See labtools.masknoise.generate_noise_masks for the arguments. The atlas
+    made from the last seed is shared like the atlases of mask images, and
+    atlases made from other seeds are evicted.
+    """
+    key = ('noise', n_frames, size, slope, seed)
+    if seed is None or key not in _atlases:
+        frames = generate_noise_masks(n_frames, size=size, slope=slope,
+                                      seed=seed, cache_dir=cache_dir)
+        atlas = MaskAtlas([Image.fromarray(frame) for frame in frames])
+        if seed is None:
+            return atlas
+        for old_key in [k for k in _atlases if k[0] == 'noise']:
+            del _atlases[old_key]
+        _atlases[key] = atlas
+    return _atlases[key]
+
+class MaskAtlas(object):
+    def __init__(self, frames):
+        """ Tile mask frames into a grid on a single texture.
+
+        Each frame is drawn by setting the spatial frequency and phase of a
+        GratingStim so that only one cell of the grid is visible.
+
+        PsychoPy rescales textures whose sides aren't powers of two, which
+        would move the edges of the cells off of texel boundaries and let
+        neighboring cells bleed into each other. The grid is put in the top
+        left corner of a texture padded to power-of-two sides, so the
+        texture is uploaded as is and every cell starts on a texel.
+
+        Parameters
+        ----------
+        frames: list of PIL.Image objects. Frames are resized to match the
+            size of the first frame.
+        """
+        self.n_frames = len(frames)
+        self.cols = int(math.ceil(math.sqrt(self.n_frames)))
+        self.rows = int(math.ceil(self.n_frames / float(self.cols)))
+
+        width, height = frames[0].size
+        self.cell_size = (width, height)
+        self.texture_size = (_next_power_of_two(self.cols * width),
+                             _next_power_of_two(self.rows * height))
+        self.image = Image.new('RGB', self.texture_size)
+        for i, frame in enumerate(frames):
+            row, col = divmod(i, self.cols)
+            self.image.paste(frame.resize((width, height)),
+                             (col * width, row * height))
+
+        # Phase that centers each cell, as a fraction of the texture,
+        # counting rows from the top. The texture is flipped when it is
+        # uploaded, so rows count up from the bottom in texture coordinates.
+        tex_width, tex_height = self.texture_size
+        self.phases = []
+        for i in range(self.n_frames):
+            row, col = divmod(i, self.cols)
+            self.phases.append((0.5 - (col + 0.5) * width / float(tex_width),
+                                (row + 0.5) * height / float(tex_height) - 0.5))
+
+        self._sprites = {}
+
+    def sf(self, size):
+        """ Spatial frequency that shows a single cell at this size. """
+        return (self.cell_size[0] / float(self.texture_size[0] * size[0]),
+                self.cell_size[1] / float(self.texture_size[1] * size[1]))
+
+    def sprite(self, win):
+        """ The GratingStim holding the atlas texture for a window. """
+        if win not in self._sprites:
+            self._sprites[win] = GratingStim(win, tex=self.image, mask=None,
+                                             interpolate=False)
+        return self._sprites[win]
+
+    def draw(self, win, frame, pos, size):
+        """ Draw a single frame of the atlas. """
+        sprite = self.sprite(win)
+        sprite.setPos(pos)
+        sprite.setSize(size)
+        sprite.setSF(self.sf(size))
+        sprite.setPhase(self.phases[frame])
+        sprite.draw()
 
 class DynamicMask(object):
     def __init__(self, **kwargs):
@@ -9,36 +123,115 @@ class DynamicMask(object):
 
         Parameters
         ----------
-        kwargs: Arguments to pass to each psychopy.visual.ImageStim object
+        kwargs: Arguments to pass to each psychopy.visual.ImageStim object.
+            If atlas=True, the images are drawn from a texture atlas shared
+            by all masks, and only win, pos, and size are used. A MaskAtlas
+            can also be given, e.g., from load_noise_atlas. If seed is given,
+            the order of the masks is randomized with its own generator.
+            A numpy Generator can be given as rng instead, e.g., a stream
+            from labtools.rng.RandomStreams.
         """
         self.is_flicker = kwargs.pop('flicker', True)
 
-        util = Path(__file__).absolute().parent
-        pngs = Path(util, 'dynamicmask').listdir(pattern = '*.png')
+        seed = kwargs.pop('seed', None)
+        rng = kwargs.pop('rng', None)
+        if rng is not None:
+            self._random = PythonRandom(rng)
+        elif seed is not None:
+            self._random = random.Random(seed)
+        else:
+            self._random = random
+
+        atlas = kwargs.pop('atlas', False)
+        if atlas:
+            self.atlas = load_atlas() if atlas is True else atlas
+            self.win = kwargs['win']
+            self.pos = kwargs.get('pos', (0, 0))
+            self.size = kwargs['size']
 
-        # workaround: psychopy checks type of image argument and expects str
-        pngs = map(str, pngs)
+            # masks are frames in the atlas
+            self.masks = list(range(self.atlas.n_frames))
+        else:
+            self.atlas = None
+            pngs = MASK_DIR.listdir(pattern = '*.png')
 
-        self.masks = [ImageStim(image = img, **kwargs) for img in pngs]
+            # workaround: psychopy checks type of image argument and expects str
+            pngs = map(str, pngs)
+
+            self.masks = [ImageStim(image = img, **kwargs) for img in pngs]
         self._ix = 1
 
     def draw(self):
         """ Draws a single mask """
-        self.masks[self._ix].draw()
+        mask = self.next_mask()
+        if self.atlas:
+            self.atlas.draw(self.win, mask, self.pos, self.size)
+        else:
+            mask.draw()
+
+    def next_mask(self):
+        """ Get the mask to draw on this frame and advance to the next one """
+        mask = self.masks[self._ix]
         if self.is_flicker:
             self._ix = (self._ix + 1) % len(self.masks)
 
             if self._ix == 0:
-                shuffle(self.masks)
+                self._random.shuffle(self.masks)
+        return mask
 
     def setPos(self, pos):
         """ Change the position for all masks"""
+        if self.atlas:
+            self.pos = pos
+            return
         for mask in self.masks:
             mask.setPos(pos)
 
     def pick_new_mask(self):
         frames = range(len(self.masks))
-        self._ix = choice(frames)
+        self._ix = self._random.choice(frames)
+
+class MaskArray(object):
+    def __init__(self, masks, stim_class=ElementArrayStim):
+        """ Draw several DynamicMasks in a single call.
+
+        Each mask keeps track of its own frames, so flickering, picking a
+        new mask, and reshuffling work the same as drawing the masks one at
+        a time. Positions and sizes are read from the masks when the array is
+        created.
+
+        Parameters
+        ----------
+        masks: list of DynamicMask objects created with atlas=True.
+        stim_class: Class used to draw the masks. Defaults to
+            psychopy.visual.ElementArrayStim.
+        """
+        atlas = masks[0].atlas
+        assert atlas and all(mask.atlas is atlas for mask in masks), \
+            'masks must share an atlas to be drawn in a single call'
+
+        self.masks = masks
+        self._phases = np.array(atlas.phases)
+        self._frames = np.zeros(len(masks), dtype=int)
+
+        self.stim = stim_class(
+            masks[0].win,
+            nElements=len(masks),
+            xys=[mask.pos for mask in masks],
+            sizes=[mask.size for mask in masks],
+            sfs=[atlas.sf(mask.size) for mask in masks],
+            phases=self._phases[self._frames],
+            elementTex=atlas.image,
+            elementMask=None,
+            interpolate=False,
+        )
+
+    def draw(self):
+        """ Draws the current frame of every mask """
+        for i, mask in enumerate(self.masks):
+            self._frames[i] = mask.next_mask()
+        self.stim.setPhases(self._phases[self._frames])
+        self.stim.draw()
 
 
 if __name__ == '__main__':
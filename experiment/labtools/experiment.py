@@ -1,6 +1,18 @@
-from psychopy import visual, event
+try:
+    from psychopy import visual, core, event, sound, logging
+except ImportError:
+    # Experiments can still run with a backend in place of psychopy
+    visual = core = event = sound = logging = None
 
 class Experiment(object):
+    # The psychopy modules used to show stimuli and collect responses.
+    # Replace them on an instance to run without a display.
+    visual = visual
+    core = core
+    event = event
+    sound = sound
+    logging = logging
+
     def show_text(self, text, **kwargs):
         settings = {
             'wrapWidth': 1000,
@@ -9,7 +21,7 @@ class Experiment(object):
             'font': 'Consolas'
         }
         settings.update(kwargs)
-        text = visual.TextStim(self.window, text=text, **settings)
+        text = self.visual.TextStim(self.window, text=text, **settings)
         text.draw()
         self.window.flip()
-        event.waitKeys()
+        self.event.waitKeys()
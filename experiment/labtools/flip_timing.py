@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+labtools.flip_timing
+
+Record the time of every flip in a trial without slowing down the frames.
+
+Flip times are written to a preallocated array during the trial. Between
+trials, they are summarized into columns for the data file and appended to
+a binary sidecar file. The sidecar starts with a JSON header describing the
+phases and refresh rate, followed by records of `FLIP_DTYPE`. Use
+:func:`read_flips` to load it.
+"""
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b'FLIPS1'
+
+FLIP_DTYPE = np.dtype([
+    ('trial', '<u4'),
+    ('frame', '<u2'),
+    ('phase', '<u1'),
+    ('time', '<f8'),
+])
+
+class FlipRecorder(object):
+    """ Timestamps each flip of a trial compiled from a FramePlan.
+
+    The last flip of each trial is the prompt, which is recorded as its own
+    phase after the phases in the frame plan.
+    """
+    def __init__(self, frame_plan, fps):
+        """
+        Parameters
+        ----------
+        frame_plan: labtools.frame_plan.FramePlan
+        fps: Expected refresh rate, used to count dropped frames.
+        """
+        self.fps = fps
+        self.phases = [name for name, _ in frame_plan.phases] + ['prompt']
+
+        n_flips = frame_plan.n_frames + 1
+        self.times = np.zeros(n_flips)
+
+        # Index of the first flip in each phase
+        self.onsets = OrderedDict(
+            (name, frame_plan.onsets[name]) for name, _ in frame_plan.phases
+        )
+        self.onsets['prompt'] = frame_plan.n_frames
+
+        # Phase code of each flip, for the sidecar file
+        codes = [[i] * n for i, (_, n) in enumerate(frame_plan.phases)]
+        codes.append([len(frame_plan.phases)])
+        self._codes = np.array(sum(codes, []), dtype='u1')
+        self._frames = np.arange(n_flips, dtype='u2')
+
+    def reset(self):
+        self.times.fill(np.nan)
+
+    def summarize(self):
+        """ Summarize the flips of the last trial.
+
+        Returns
+        -------
+        OrderedDict with the actual cue to target SOA in seconds, the measured
+        duration of each phase in ms, and the number of dropped frames.
+        """
+        onset_times = self.times[list(self.onsets.values())]
+        durations = np.diff(onset_times) * 1000
+
+        summary = OrderedDict()
+        summary['measured_soa'] = (self.times[self.onsets['target']] -
+                                   self.times[self.onsets['cue']])
+        for name, duration in zip(self.phases[:-1], durations):
+            summary[name + '_ms'] = duration
+
+        # Any interval longer than a single refresh means frames were dropped
+        refreshes = np.round(np.diff(self.times) * self.fps)
+        summary['dropped_frames'] = int(np.maximum(refreshes - 1, 0).sum())
+        return summary
+
+    def write_header(self, sidecar):
+        """ Write the phases and refresh rate at the top of a sidecar file. """
+        header = json.dumps({'phases': self.phases, 'fps': self.fps})
+        header = header.encode('utf-8')
+        sidecar.write(MAGIC)
+        sidecar.write(struct.pack('<I', len(header)))
+        sidecar.write(header)
+
+    def write(self, sidecar, trial):
+        """ Append the flips of the last trial to a sidecar file. """
+        records = np.empty(len(self.times), dtype=FLIP_DTYPE)
+        records['trial'] = trial
+        records['frame'] = self._frames
+        records['phase'] = self._codes
+        records['time'] = self.times
+        sidecar.write(records.tobytes())
+        sidecar.flush()
+
+def read_flips(sidecar_path):
+    """
+    Load the flips recorded in a sidecar file.
+
+    :param str sidecar_path: Path to a file written by a FlipRecorder.
+    :return: Header info and an array of records with dtype `FLIP_DTYPE`.
+    :rtype: tuple of (dict, numpy.ndarray)
+    """
+    with open(sidecar_path, 'rb') as sidecar:
+        magic = sidecar.read(len(MAGIC))
+        assert magic == MAGIC, '%s is not a flips file' % sidecar_path
+        header_len, = struct.unpack('<I', sidecar.read(4))
+        header = json.loads(sidecar.read(header_len).decode('utf-8'))
+        flips = np.frombuffer(sidecar.read(), dtype=FLIP_DTYPE)
+    return header, flips
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+labtools.frame_plan
+"""
+
+def to_n_frames(time_in_seconds, fps):
+    """
+    Convert a duration to the nearest whole number of frames.
+
+    :param float time_in_seconds: Duration to convert.
+    :param float fps: Refresh rate of the window.
+    :return: Number of frames.
+    :rtype: int
+    """
+    return int(round(time_in_seconds * fps))
+
+def measure_fps(window, default):
+    """
+    Measure the refresh rate of a window.
+
+    :param psychopy.visual.Window window: Window to measure.
+    :param float default: Refresh rate to use if psychopy can't get a stable
+        measurement.
+    :return: Frames per second.
+    :rtype: float
+    """
+    fps = window.getActualFrameRate()
+    if fps is None:
+        fps = default
+    return fps
+
+class FramePlan(object):
+    """ The phases of a trial, each lasting a whole number of frames.
+
+    A plan is built once per session, and compiled into a flat schedule with
+    one (phase, draw_list) entry per frame on each trial.
+    """
+    def __init__(self, phases):
+        """
+        Parameters
+        ----------
+        phases: list of (name, n_frames) tuples in order of presentation.
+        """
+        self.phases = list(phases)
+
+        self.onsets = {}
+        n_frames = 0
+        for name, n in self.phases:
+            self.onsets[name] = n_frames
+            n_frames += n
+        self.n_frames = n_frames
+
+    def compile(self, draw_lists):
+        """ Expand the plan into a schedule of frames.
+
+        Parameters
+        ----------
+        draw_lists: dict of phase names to lists of objects with a draw method.
+
+        Returns
+        -------
+        list of (phase, draw_list) tuples, one per frame.
+        """
+        schedule = []
+        for name, n in self.phases:
+            schedule.extend([(name, draw_lists[name])] * n)
+        return schedule
@@ -4,71 +4,153 @@ labtools.generator_functions
 """
 import pandas as pd
 
-from numpy import arange
+from numpy import (arange, argsort, bincount, concatenate, cumsum, empty,
+                   resize, searchsorted)
 from numpy.random import RandomState
 
-def _circular_generator(source, prng=None):
+from .rng import random_state
+
+def _circular_indices(num_options, num_draws, prng=None):
     """
-    Yield rows from source with optional randomization.
+    Positions of the rows drawn by cycling through a source.
+    
+    Every option is drawn once before any option is drawn again. If `prng` is
+    given, the order is shuffled at the start of each cycle, and each
+    cycle's order is made by shuffling the order of the previous cycle.
     
-    :param pandas.DataFrame source: Frame to yield from.
+    :param int num_options: Number of rows in the source.
+    :param int num_draws: Number of rows to draw.
     :param prng: Optional randomizer.
     :type prng: numpy.random.RandomState or None
-    :return: Yields rows from source.
-    :rtype: pandas.Series
+    :return: Integer positions of the rows to draw.
+    :rtype: numpy.ndarray
     """
-    ix_options = source.index.tolist()
-    num_options = len(ix_options)
+    if num_options == 0 and num_draws > 0:
+        raise ValueError('cannot draw from an empty source')
     
-    if prng is not None:
-        prng.shuffle(ix_options)
+    order = arange(num_options)
+    if num_draws == 0 or prng is None:
+        return resize(order, num_draws)
     
-    ix = 0
-    while True:
-        next_ix = ix_options[ix]
-        yield source.ix[next_ix]
-        ix = (ix+1)%num_options
-        
-        if prng is not None and ix%num_options == 0:
-            prng.shuffle(ix_options)
+    num_cycles = -(-num_draws // num_options)
+    cycles = []
+    for _ in range(num_cycles):
+        prng.shuffle(order)
+        cycles.append(order.copy())
+    
+    return concatenate(cycles)[:num_draws]
+
+def _to_numeric(frame):
+    """
+    Convert the columns of a frame to numbers where possible.
+    
+    :param pandas.DataFrame frame: Frame to convert in place.
+    :return: The converted frame.
+    :rtype: pandas.DataFrame
+    """
+    for col in frame.columns:
+        try:
+            frame[col] = pd.to_numeric(frame[col])
+        except (ValueError, TypeError):
+            pass
+    return frame
+
+def _as_source_cols(source, source_cols):
+    """
+    Map columns of `source` to the names they'll have in the trial list.
+    
+    :rtype: dict
+    """
+    if source_cols is None:
+        source_cols = source.columns
+    elif isinstance(source_cols, str) or not hasattr(source_cols, '__iter__'):
+        source_cols = [source_cols,]
+    
+    if not isinstance(source_cols, dict):
+        source_cols = dict(zip(source_cols, source_cols))
+    
+    return source_cols
 
-def generate(frame, source, source_cols=None, seed=None):
+def _add_source_rows(frame, source, positions, source_cols, preserve_dtypes):
+    """
+    Add columns to a trial list from the rows of source at positions.
+    
+    :param pandas.DataFrame frame: Trial list.
+    :param pandas.DataFrame source: Source list.
+    :param numpy.ndarray positions: Position in `source` for each trial.
+    :param dict source_cols: See :func:`_as_source_cols`.
+    :param bool preserve_dtypes: See :func:`generate`.
+    :return: The `frame` with additional `source_cols` from `source`.
+    :rtype: pandas.DataFrame
+    """
+    g_frame = source[list(source_cols.keys())].take(positions)
+    g_frame = g_frame.rename(columns = source_cols)
+    
+    if not preserve_dtypes:
+        g_frame = _to_numeric(g_frame.astype(object))
+    
+    g_frame.index = frame.index
+    new_cols = list(source_cols.values())
+    frame[new_cols] = g_frame[new_cols]
+    
+    return frame
+
+def generate(frame, source, source_cols=None, seed=None, preserve_dtypes=True):
     """
     Adds columns to a trial list from a source using a circular generator.
     
+    The positions of all of the rows are computed up front by
+    :func:`_circular_indices` and taken from `source` at once.
+    
     :param pandas.DataFrame frame: Trial list.
     :param pandas.DataFrame source: Source list.
     :param source_cols: Columns of `source` to add to `frame`. Defaults to
         adding all columns of `source`. If `source_cols` is a dict, keys will be 
         renamed to values.
     :type source_cols: str, list, dict, or None
-    :param seed: Seed random number generator.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from.
+    :type seed: int, numpy.random.Generator, or None
+    :param bool preserve_dtypes: Keep the dtypes of the `source` columns. If
+        False, columns are converted to numbers where possible, as when rows
+        were combined one at a time.
     :return: The `frame` with additional `source_cols` from `source`.
     :rtype: pandas.DataFrame
     """
     prng = None
     
     if seed is not None:
-        prng = RandomState(seed)
-    
-    if source_cols is None:
-        source_cols = source.columns
-    elif not hasattr(source_cols, '__iter__'):
-        source_cols = [source_cols,]
-    
-    if not isinstance(source_cols, dict):
-        source_cols = dict(zip(source_cols, source_cols))
+        prng = random_state(seed)
     
-    gen = _circular_generator(source, prng)
-    g_frame = pd.concat([gen.next() for _ in xrange(len(frame))], axis=1).T
-    g_frame = g_frame.convert_objects(convert_numeric = True)
-    g_frame = g_frame[source_cols.keys()].rename(columns = source_cols)
+    source_cols = _as_source_cols(source, source_cols)
+    positions = _circular_indices(len(source), len(frame), prng)
+    return _add_source_rows(frame, source, positions, source_cols,
+                            preserve_dtypes)
+
+def _group_seeds(num_groups, seed):
+    """
+    Create unique seeds for each group.
     
-    g_frame.index = frame.index
-    frame[source_cols.values()] = g_frame[source_cols.values()]
+    :rtype: list
+    """
+    num_seeds = num_groups + 1
+    if seed is not None:
+        prng = random_state(seed)
+        return list(prng.choice(arange(1000), num_seeds))
+    return [None]*num_seeds
+
+def _group_positions(codes, num_groups):
+    """
+    Index rows by group.
     
-    return frame
+    :param numpy.ndarray codes: Group of each row, from 0 to num_groups - 1.
+    :return: Positions of rows sorted by group, in their original order
+        within each group, and the start and stop of each group.
+    :rtype: tuple
+    """
+    order = argsort(codes, kind='mergesort')
+    stops = cumsum(bincount(codes, minlength=num_groups))
+    starts = stops - bincount(codes, minlength=num_groups)
+    return order, starts, stops
 
 def generate_by_group(frame, by, source_map, source_cols=None, seed=None):
     """
@@ -87,28 +169,26 @@ def generate_by_group(frame, by, source_map, source_cols=None, seed=None):
         adding all columns of `source`. If `source_cols` is a dict, keys will be 
         renamed to values.
     :type source_cols: str, list, dict, or None
-    :param seed: Seed random number generator. If `None` the result will not be
-        randomized.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from. If
+        `None` the result will not be randomized.
+    :type seed: int, numpy.random.Generator, or None
     :return: The `frame` with additional `source_cols` from `source`.
     :rtype: pandas.DataFrame
     """
-    # create unique seeds for each part
-    num_seeds = len(frame[by].unique()) + 1
-    if seed is not None:
-        prng = RandomState(seed)
-        seeds = list(prng.choice(arange(1000), num_seeds))
-    else:
-        seeds = [None]*num_seeds
-        
-    def _generate_for_group(grp):
-        group_key = grp[by].unique()[0]
-        group_source = source_map[group_key]
-        group_frame = generate(grp, group_source, source_cols, seeds.pop())
-        group_frame.index = grp.index
-        return group_frame
+    codes, group_keys = pd.factorize(frame[by], sort=True)
+    seeds = _group_seeds(len(group_keys), seed)
+    order, starts, stops = _group_positions(codes, len(group_keys))
+    
+    chunks = []
+    for group, group_key in enumerate(group_keys):
+        rows = order[starts[group]:stops[group]]
+        group_frame = frame.iloc[rows].copy()
+        chunks.append(generate(group_frame, source_map[group_key],
+                               source_cols, seeds.pop()))
     
-    return frame.groupby(by, group_keys=False).apply(_generate_for_group)
+    # Put the trials back in their original order
+    new_frame = pd.concat(chunks)
+    return new_frame.iloc[argsort(order, kind='mergesort')]
 
 def create_source_map(source, on, source_keys, comparison_func):
     """
@@ -130,74 +210,140 @@ def create_source_map(source, on, source_keys, comparison_func):
     
     return source_map
 
+def _split_on(on):
+    """
+    Columns of the trial list and the source to match on.
+    
+    :param on: A column in both, a [frame column, source column] pair, a
+        list of pairs, or a dict of frame columns to source columns.
+    :return: List of frame columns and list of source columns.
+    :rtype: tuple
+    """
+    if isinstance(on, dict):
+        pairs = list(on.items())
+    elif not isinstance(on, list):
+        pairs = [(on, on)]
+    elif all(isinstance(pair, tuple) for pair in on):
+        pairs = on
+    else:
+        pairs = [tuple(on)]
+    return [f for f, _ in pairs], [s for _, s in pairs]
+
+def _key_codes(frame, f_on, source, s_on):
+    """
+    Factorize the keys of a trial list and a source together.
+    
+    Each unique combination of values in the key columns gets a code, and
+    the codes are shared between the trial list and the source. Codes are in
+    sorted order of the keys.
+    
+    :return: Codes for the rows of `frame`, codes for the rows of `source`,
+        and the number of codes.
+    :rtype: tuple
+    """
+    num_frame = len(frame)
+    codes = None
+    for f_col, s_col in zip(f_on, s_on):
+        values = concatenate([frame[f_col].values, source[s_col].values])
+        col_codes, uniques = pd.factorize(values, sort=True)
+        if codes is None:
+            codes = col_codes
+        else:
+            codes, _ = pd.factorize(codes*len(uniques) + col_codes, sort=True)
+    num_codes = codes.max() + 1 if len(codes) else 0
+    return codes[:num_frame], codes[num_frame:], num_codes
+
+def _generate_on(frame, source, on, source_cols, seed, but_not):
+    """
+    Adds columns to a trial list from the rows of source with matching or
+    non-matching keys.
+    
+    The source is indexed once by sorting its rows by key. Matching rows are
+    a slice of the index. Non-matching rows are drawn without being
+    collected: a draw of the `j`-th non-matching row is moved past the
+    matching rows that come before it.
+    
+    :rtype: pandas.DataFrame
+    """
+    f_on, s_on = _split_on(on)
+    frame_codes, source_codes, num_codes = _key_codes(frame, f_on, source,
+                                                      s_on)
+    source_order, source_starts, source_stops = _group_positions(
+        source_codes, num_codes)
+    
+    groups = pd.unique(frame_codes)
+    groups.sort()
+    seeds = _group_seeds(len(groups), seed)
+    frame_order, frame_starts, frame_stops = _group_positions(frame_codes,
+                                                              num_codes)
+    
+    positions = empty(len(frame), dtype=int)
+    for group in groups:
+        group_seed = seeds.pop()
+        prng = RandomState(group_seed) if group_seed is not None else None
+        rows = frame_order[frame_starts[group]:frame_stops[group]]
+        matches = source_order[source_starts[group]:source_stops[group]]
+        
+        if not but_not:
+            picks = _circular_indices(len(matches), len(rows), prng)
+            positions[rows] = matches[picks]
+        else:
+            picks = _circular_indices(len(source) - len(matches), len(rows),
+                                      prng)
+            shifted = matches - arange(len(matches))
+            positions[rows] = picks + searchsorted(shifted, picks,
+                                                   side='right')
+    
+    source_cols = _as_source_cols(source, source_cols)
+    return _add_source_rows(frame, source, positions, source_cols, True)
+
 def generate_matches(frame, source, on, source_cols=None, seed=None):
     """
     Adds columns to a trial list based on *matching* values in source.
     
-    For more information:
-        * on how the columns are added, see :func:`generate_by_group`.
-        * on how the matching values are selected, see 
-          :func:`create_source_map`
+    Each trial gets a row of `source` with the same values in the `on`
+    columns, drawn as in :func:`generate` from the rows for its values.
     
     :param pandas.DataFrame frame:
-    :param pandas.DataFrame source: Full options to split into the source_map.
-    :param on: Column names to match source and frame on.
-    :type on: str or list
+    :param pandas.DataFrame source: Full options to draw from.
+    :param on: Column names to match source and frame on. A str is a column
+        in both, a list is a [frame column, source column] pair, and a dict
+        or list of pairs matches on several columns.
+    :type on: str, list, or dict
     :param source_cols: Columns of `source` to add to `frame`. Defaults to
         adding all columns of `source`. If `source_cols` is a dict, keys will be 
         renamed to values.
     :type source_cols: str, list, dict, or None
-    :param seed: Seed random number generator. If `None` the result will not be
-        randomized.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from. If
+        `None` the result will not be randomized.
+    :type seed: int, numpy.random.Generator, or None
     :return: The `frame` with additional `source_cols` from sources.
     :rtype: pandas.DataFrame
     """
-    if not isinstance(on, list):
-        on = [on, on]
-    f_on, s_on = on
-    
-    source_keys = frame[f_on].unique()
-    
-    def _is_equal(x, y): 
-        return x == y
-    
-    source_map = create_source_map(source, s_on, source_keys, _is_equal)
-    
-    return generate_by_group(frame, f_on, source_map, source_cols, seed)
+    return _generate_on(frame, source, on, source_cols, seed, but_not=False)
 
 def generate_but_not(frame, source, on, source_cols=None, seed=None):
     """
     Adds columns to a trial list based on *non-matching* values in source.
     
-    For more information:
-        * on how the columns are added, see :func:`generate_by_group`.
-        * on how the non-matching values are selected, see 
-          :func:`create_source_map`
+    Each trial gets a row of `source` with different values in the `on`
+    columns, drawn as in :func:`generate` from the rows that don't match.
+    With several columns, a row doesn't match if any of the values differ.
     
     :param pandas.DataFrame frame:
-    :param pandas.DataFrame source: Full options to split into the source_map.
-    :param on: Column names to match source and frame on.
-    :type on: str or list
+    :param pandas.DataFrame source: Full options to draw from.
+    :param on: Column names to match source and frame on. A str is a column
+        in both, a list is a [frame column, source column] pair, and a dict
+        or list of pairs matches on several columns.
+    :type on: str, list, or dict
     :param source_cols: Columns of `source` to add to `frame`. Defaults to
         adding all columns of `source`. If `source_cols` is a dict, keys will be 
         renamed to values.
     :type source_cols: str, list, dict, or None
-    :param seed: Seed random number generator. If `None` the result will not be
-        randomized.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from. If
+        `None` the result will not be randomized.
+    :type seed: int, numpy.random.Generator, or None
     :return: The `frame` with additional `source_cols` from sources.
     :rtype: pandas.DataFrame
     """
-    if not isinstance(on, list):
-        on = [on, on]
-    f_on, s_on = on
-    
-    source_keys = frame[f_on].unique()
-    
-    def _is_not_equal(x, y):
-        return x != y
-    
-    source_map = create_source_map(source, s_on, source_keys, _is_not_equal)
-    
-    return generate_by_group(frame, f_on, source_map, source_cols, seed)
+    return _generate_on(frame, source, on, source_cols, seed, but_not=True)
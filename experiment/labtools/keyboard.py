@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+labtools.keyboard
+"""
+try:
+    from psychopy import event, logging
+except ImportError:
+    # A backend without psychopy, e.g., labtools.simulation.Simulation,
+    # passes its own event module and clock.
+    event = logging = None
+
+class Keyboard(object):
+    """ Collects key presses with the time each key went down.
+
+    Presses are timestamped by psychopy when the key event arrives, not when
+    the keyboard is checked, so presses made while frames are being drawn
+    keep their original times. Times are on the same clock as the values
+    returned by Window.flip(), so response times can be measured from the
+    flip that showed a stimulus.
+    """
+    def __init__(self, key_list, event=event, clock=None):
+        """
+        Parameters
+        ----------
+        key_list: Keys to listen for.
+        event: Module with psychopy.event's clearEvents, getKeys, and
+            waitKeys functions.
+        clock: Clock for timestamping presses. Defaults to the clock used
+            to timestamp flips, psychopy.logging.defaultClock.
+        """
+        self.key_list = list(key_list)
+        self.event = event
+        self.clock = clock or logging.defaultClock
+
+    def clear(self):
+        """ Forget any presses that haven't been collected. """
+        self.event.clearEvents(eventType='keyboard')
+
+    def get_presses(self):
+        """ Get the presses since the last clear, without waiting.
+
+        Returns
+        -------
+        list of (key, time) tuples.
+        """
+        return self.event.getKeys(keyList=self.key_list,
+                                  timeStamped=self.clock)
+
+    def wait_press(self, max_wait):
+        """ Wait for a press.
+
+        Returns
+        -------
+        list of (key, time) tuples, which is empty if max_wait elapsed.
+        """
+        presses = self.event.waitKeys(maxWait=max_wait, keyList=self.key_list,
+                                      timeStamped=self.clock)
+        return presses or []
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+labtools.masknoise
+
+Generate mask frames from filtered noise instead of loading them from images.
+"""
+import os
+
+import numpy as np
+from numpy.random import RandomState
+
+# Frames generated in this process for the most recent seed. Frames for
+# other seeds are evicted, so running one participant after another in the
+# same process doesn't keep every participant's frames.
+_cache = {}
+
+def _remember(key, frames):
+    _cache.clear()
+    _cache[key] = frames
+    return frames
+
+def generate_noise_masks(n_frames, size=128, slope=1.0, seed=None,
+                         channels=3, cache_dir=None):
+    """
+    Generate colored noise frames with a 1/f^slope amplitude spectrum.
+
+    All frames are generated at once, and the frames for the last seed used
+    are kept in memory. If `cache_dir` is given, frames generated with a seed
+    are also saved to and loaded from .npy files in that directory.
+
+    :param int n_frames: Number of frames to generate.
+    :param size: Size of each frame in pixels.
+    :type size: int or (height, width) tuple
+    :param float slope: Exponent of the amplitude spectrum. 0 is white noise,
+        1 is pink noise, and 2 is brown noise. Defaults to 1.
+    :param seed: Seed random number generator. Frames are only cached if a
+        seed is provided.
+    :type seed: int or None
+    :param int channels: Number of color channels. Defaults to 3 (RGB).
+    :param cache_dir: Optional directory for saving generated frames.
+    :type cache_dir: str or None
+    :return: Frames with shape (n_frames, height, width, channels).
+    :rtype: numpy.ndarray of uint8
+    """
+    if not hasattr(size, '__iter__'):
+        size = (size, size)
+    height, width = size
+
+    key = (n_frames, height, width, float(slope), seed, channels)
+    if seed is not None and key in _cache:
+        return _cache[key]
+
+    cache_file = None
+    if seed is not None and cache_dir is not None:
+        name = 'masknoise-{}-{}x{}-{}-{}-{}.npy'.format(*key)
+        cache_file = os.path.join(cache_dir, name)
+        if os.path.exists(cache_file):
+            return _remember(key, np.load(cache_file))
+
+    prng = RandomState(seed)
+    white = prng.standard_normal((n_frames, channels, height, width))
+
+    # Scale the amplitude of each spatial frequency by 1/f^slope,
+    # dropping the mean luminance (f = 0).
+    fy = np.fft.fftfreq(height)[:, np.newaxis]
+    fx = np.fft.rfftfreq(width)[np.newaxis, :]
+    f = np.sqrt(fx**2 + fy**2)
+    f[0, 0] = 1.0
+    spectrum_filter = 1.0 / f**slope
+    spectrum_filter[0, 0] = 0.0
+
+    noise = np.fft.irfft2(np.fft.rfft2(white) * spectrum_filter,
+                          s=(height, width))
+
+    # Give each channel of each frame the same contrast, clipping values
+    # more than 3 standard deviations from the mean.
+    noise /= noise.std(axis=(2, 3), keepdims=True)
+    noise = np.clip(0.5 + noise / 6.0, 0.0, 1.0)
+
+    frames = (noise * 255).round().astype(np.uint8)
+    frames = frames.transpose(0, 2, 3, 1)
+
+    if seed is not None:
+        _remember(key, frames)
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            np.save(cache_file, frames)
+
+    return frames
@@ -1,5 +1,5 @@
 import yaml
-from UserDict import UserDict
+from collections import UserDict
 
 import unipath
 
@@ -11,7 +11,7 @@ class Participant(UserDict):
     @classmethod
     def from_yaml(cls, participant_yaml):
         with open(participant_yaml, 'r') as f:
-            data = yaml.load(f)
+            data = yaml.safe_load(f)
             data['participant_yaml'] = participant_yaml
         return cls(data)
 
@@ -51,7 +51,7 @@ class Participant(UserDict):
             data_filename = unipath.Path(self['data_dir'],
                                          subj_info['subj_id'] + '.csv')
             if data_filename.exists():
-                print 'that data file already exists'
+                print('that data file already exists')
             else:
                 misc.toFile(last_dlg_data, dlg_data)
                 break
@@ -4,8 +4,13 @@ import random
 import socket
 
 from unipath import Path
+from PIL import Image
 
-from psychopy import core, event, visual, data, gui, misc, sound
+try:
+    from psychopy import core, event, visual, data, gui, misc, sound
+except ImportError:
+    # The stimulus registry can be used with loaders from another backend
+    core = event = visual = data = gui = misc = sound = None
 
 def enter_subj_info(exp_name, options, unique = True, exp_dir = './',
         data_dir = './'):
@@ -139,16 +144,75 @@ def load_images(image_dir, ext, **kwargs):
 
     return images
 
-def load_sounds(sound_dir, pattern):
+def load_sounds(sound_dir, pattern, registry=None, loader=None):
+    loader = loader or sound.Sound
     sound_dir = Path(sound_dir)
     sound_names = sound_dir.listdir(pattern = pattern)
     sounds = {}
     for snd_name in sound_names:
         snd_stem = str(snd_name.stem)
-        sounds[snd_stem] = sound.Sound(snd_name)
+        if registry is None:
+            sounds[snd_stem] = loader(snd_name)
+        else:
+            sounds[snd_stem] = registry.get(snd_name, loader)
 
     return sounds
 
+def _decode_image(path):
+    image = Image.open(path)
+    image.load()
+    return image
+
+class StimulusRegistry(object):
+    """ Cache decoded stimuli for every session run in this process.
+
+    Stimuli are loaded the first time they are requested, and are reloaded
+    if the file has been modified since. The same file loaded by different
+    loaders is cached separately. Call sweep() once a session has requested
+    everything it needs to evict the stimuli it didn't use.
+    """
+    def __init__(self):
+        self._entries = {}  # (path, loader) -> (mtime, stimulus)
+        self._requested = set()
+
+    def get(self, path, loader):
+        """ Get the stimulus for a file, loading it if necessary.
+
+        Parameters
+        ----------
+        path: Path to the stimulus file.
+        loader: Function that takes the path and returns the stimulus.
+        """
+        path = os.path.abspath(str(path))
+        key = (path, loader)
+        mtime = os.path.getmtime(path)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, loader(path))
+            self._entries[key] = entry
+        self._requested.add(key)
+        return entry[1]
+
+    def image(self, path):
+        """ Get a decoded PIL.Image that can be passed to an ImageStim. """
+        return self.get(path, _decode_image)
+
+    def sound(self, path):
+        """ Get a psychopy.sound.Sound. """
+        return self.get(path, sound.Sound)
+
+    def sweep(self):
+        """ Evict stimuli that weren't requested since the last sweep. """
+        for key in set(self._entries) - self._requested:
+            del self._entries[key]
+        self._requested = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+# Shared by all experiments run in this process
+stimuli = StimulusRegistry()
+
 def write_list_to_file(line, file, close=False):
     line = '\t'.join([str(value) for value in line]) + '\n'
     file.write(line)
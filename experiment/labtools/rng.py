@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+labtools.rng
+
+Independent random number streams for the parts of an experiment.
+
+Each part of an experiment, e.g., the trial list, the masks at each
+location, or the jitter of the target, gets its own numpy Generator. The
+generators are made from a numpy SeedSequence with the participant's seed
+as the entropy and a spawn key made from the name of the part, so a part
+gets the same numbers no matter what other parts draw, in what order, or in
+which thread. Recording the entropy and the names of the streams is enough
+to reproduce every draw.
+"""
+import json
+import zlib
+from collections import OrderedDict
+
+from numpy.random import Generator, PCG64, RandomState, SeedSequence
+
+def _spawn_key(names):
+    return tuple(zlib.crc32(str(name).encode('utf-8')) & 0xffffffff
+                 for name in names)
+
+def random_state(seed):
+    """ Get a RandomState for the seed argument of a labtools function.
+
+    Parameters
+    ----------
+    seed: None, an int, a RandomState, or a numpy Generator. A RandomState
+        made from a Generator draws from the Generator's stream.
+    """
+    if isinstance(seed, RandomState):
+        return seed
+    if isinstance(seed, Generator):
+        return RandomState(seed.bit_generator)
+    return RandomState(seed)
+
+class PythonRandom(object):
+    """ The parts of the random module's interface used by labtools, drawn
+    from a numpy Generator. """
+    def __init__(self, generator):
+        self.generator = generator
+
+    def random(self):
+        return float(self.generator.random())
+
+    def uniform(self, a, b):
+        return float(self.generator.uniform(a, b))
+
+    def normalvariate(self, mu, sigma):
+        return float(self.generator.normal(mu, sigma))
+
+    def choice(self, seq):
+        seq = list(seq)
+        return seq[int(self.generator.integers(len(seq)))]
+
+    def shuffle(self, x):
+        self.generator.shuffle(x)
+
+class RandomStreams(object):
+    """ Named random number streams made from one seed. """
+    def __init__(self, seed=None, prefix=()):
+        """
+        Parameters
+        ----------
+        seed: Entropy for all of the streams, e.g., the participant's seed.
+            If None, fresh entropy is used, and can be read from the
+            entropy attribute.
+        prefix: Names put before the names of every stream.
+        """
+        self.entropy = SeedSequence(seed).entropy
+        self.prefix = tuple(prefix)
+        self._streams = OrderedDict()
+
+    def child(self, *names):
+        """ Streams for part of the experiment, e.g., one participant. """
+        names = tuple(str(name) for name in names)
+        child = RandomStreams(self.entropy, self.prefix + names)
+        child._streams = self._streams  # record the streams in one place
+        return child
+
+    def seed_sequence(self, *names):
+        return SeedSequence(self.entropy,
+                            spawn_key=_spawn_key(self.prefix + names))
+
+    def generator(self, *names):
+        """ Get the Generator for a stream.
+
+        Asking for the same names again gives the same Generator, which
+        continues where it left off.
+        """
+        key = self.prefix + tuple(str(name) for name in names)
+        if key not in self._streams:
+            bit_generator = PCG64(self.seed_sequence(*names))
+            self._streams[key] = Generator(bit_generator)
+        return self._streams[key]
+
+    def record(self, *names):
+        """ Record a stream without drawing from it, e.g., for numbers that
+        were drawn from the start of the stream ahead of time. """
+        self.generator(*names)
+
+    def python_random(self, *names):
+        """ Get a stream with the interface of the random module. """
+        return PythonRandom(self.generator(*names))
+
+    def state(self):
+        """ The entropy and the current state of every stream. """
+        streams = OrderedDict()
+        for key, generator in self._streams.items():
+            streams['/'.join(key)] = OrderedDict([
+                ('spawn_key', list(_spawn_key(key))),
+                ('state', generator.bit_generator.state),
+            ])
+        return OrderedDict([('entropy', self.entropy), ('streams', streams)])
+
+    def write(self, filename):
+        """ Save the state of the streams as JSON. """
+        with open(str(filename), 'w') as f:
+            json.dump(self.state(), f, indent=2)
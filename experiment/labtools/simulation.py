@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+labtools.simulation
+
+Stand-ins for psychopy's visual, core, event, sound, and logging modules,
+for running an experiment without a display or a participant. Nothing here
+imports psychopy.
+
+Time is kept by a virtual clock that fast-forwards instead of sleeping: each
+flip advances it by one frame, waits advance it by the time waited, and
+responses advance it by the response time of a simulated participant.
+Responses come from a responder, which can be swapped out to model
+different participants.
+"""
+import random
+
+class VirtualClock(object):
+    """ Shared time for everything in a simulation. """
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class Clock(object):
+    """ A psychopy.core.Clock that reads the time from a VirtualClock. """
+    def __init__(self, virtual_clock):
+        self._clock = virtual_clock
+        self._start = virtual_clock.now
+
+    def getTime(self):
+        return self._clock.now - self._start
+
+    def reset(self, newT=0.0):
+        self._start = self._clock.now + newT
+
+def _ignore(*args, **kwargs):
+    pass
+
+class VirtualStim(object):
+    """ Accepts the arguments for any stimulus and shows nothing. """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def draw(self, *args, **kwargs):
+        pass
+
+    def play(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        # setText, setPos, setPhases, etc.
+        if name.startswith('set'):
+            return _ignore
+        raise AttributeError(name)
+
+class VirtualWindow(object):
+    """ A window that flips at a fixed refresh rate without drawing. """
+    def __init__(self, virtual_clock, fps, **kwargs):
+        self._clock = virtual_clock
+        self._frame_duration = 1.0 / fps
+        self._to_call = []
+        self.fps = fps
+        self.units = kwargs.get('units', 'pix')
+        self.size = kwargs.get('size', (1920, 1080))
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.fps
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        self._clock.advance(self._frame_duration)
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+        return self._clock.now
+
+    def close(self):
+        pass
+
+class Responder(object):
+    """ A simulated participant.
+
+    Subclasses implement respond to pick a key and a response time for
+    the current trial.
+    """
+    def respond(self, trial, key_list):
+        """ Respond to a trial.
+
+        Parameters
+        ----------
+        trial: The trial being run.
+        key_list: Keys that will be accepted.
+
+        Returns
+        -------
+        (key, rt) tuple, where rt is the number of seconds from the start
+        of the wait. Return (None, None) to let the trial time out.
+        """
+        raise NotImplementedError
+
+class CueValidityResponder(Responder):
+    """ Responds faster and more accurately after valid cues.
+
+    Responses are correct with a probability that depends on the
+    cue_validity of the trial, and response times are drawn from a normal
+    distribution with a mean that depends on cue_validity. Incorrect
+    responses pick one of the other keys at random.
+    """
+    rt_means = {'valid': 0.45, 'neutral': 0.5, 'invalid': 0.55}
+    accuracies = {'valid': 0.9, 'neutral': 0.85, 'invalid': 0.8}
+
+    def __init__(self, rt_means=None, accuracies=None, rt_sd=0.1,
+                 min_rt=0.15, timeout_rate=0.01, seed=None):
+        if rt_means is not None:
+            self.rt_means = dict(self.rt_means, **rt_means)
+        if accuracies is not None:
+            self.accuracies = dict(self.accuracies, **accuracies)
+        self.rt_sd = rt_sd
+        self.min_rt = min_rt
+        self.timeout_rate = timeout_rate
+        self._random = random.Random(seed)
+
+    def respond(self, trial, key_list):
+        if self._random.random() < self.timeout_rate:
+            return None, None
+
+        validity = trial.cue_validity
+        rt = self._random.normalvariate(self.rt_means[validity], self.rt_sd)
+        rt = max(rt, self.min_rt)
+
+        key_list = sorted(key_list)
+        is_correct = self._random.random() < self.accuracies[validity]
+        if is_correct and trial.target_loc in key_list:
+            key = trial.target_loc
+        else:
+            key = self._random.choice(
+                [k for k in key_list if k != trial.target_loc]
+            )
+        return key, rt
+
+class _Namespace(object):
+    pass
+
+class Simulation(object):
+    """ Replacements for psychopy modules for a headless experiment.
+
+    Pass a Simulation as the backend of an experiment, and set
+    simulation.trial to the trial being run so the responder knows what to
+    respond to. Waits for any key, e.g., during instructions, or when no
+    trial is set return 'space' immediately.
+    """
+    def __init__(self, responder=None, fps=120.0):
+        self.clock = VirtualClock()
+        self.responder = responder or CueValidityResponder()
+        self.fps = fps
+        self.trial = None
+
+        self.visual = _Namespace()
+        self.visual.Window = self.Window
+        for name in ['TextStim', 'ImageStim', 'Rect', 'GratingStim',
+                     'ElementArrayStim']:
+            setattr(self.visual, name, VirtualStim)
+
+        self.core = _Namespace()
+        self.core.Clock = self.Clock
+        self.core.wait = self.wait
+        self.core.quit = self.quit
+
+        self.event = _Namespace()
+        self.event.waitKeys = self.waitKeys
+        self.event.getKeys = self.getKeys
+        self.event.clearEvents = _ignore
+
+        # Flips and key presses are timestamped on the same clock
+        self.logging = _Namespace()
+        self.logging.defaultClock = self.Clock()
+
+        self.sound = _Namespace()
+        self.sound.Sound = VirtualStim
+
+    def Window(self, *args, **kwargs):
+        return VirtualWindow(self.clock, self.fps, **kwargs)
+
+    def Clock(self):
+        return Clock(self.clock)
+
+    def wait(self, secs, hogCPUperiod=0.2):
+        self.clock.advance(secs)
+
+    def quit(self):
+        raise SystemExit
+
+    def getKeys(self, keyList=None, timeStamped=False):
+        # Simulated participants only respond once they are waited for
+        return []
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, timeStamped=False):
+        if self.trial is None or keyList is None:
+            key, rt = 'space', 0.0
+        else:
+            key, rt = self.responder.respond(self.trial, keyList)
+
+        if key is None or rt > maxWait:
+            self.clock.advance(maxWait)
+            return None
+
+        self.clock.advance(rt)
+        if timeStamped:
+            return [(key, self.clock.now)]
+        return [key]
@@ -1,8 +1,17 @@
-from psychopy.data import StairHandler
+from itertools import product
 
 import numpy as np
 
-def new_staircase(desired_accuracy):
+from .rng import random_state
+
+# Settings for the staircases made by new_staircase
+STAIRCASE_SETTINGS = dict(
+    startVal = 0.8,
+    nReversals = 4, stepSizes = [0.2, 0.1, 0.06, 0.03], stepType = 'lin',
+    nTrials = 100, minVal = 0.01, maxVal = 1.0,
+)
+
+def up_down_rule(desired_accuracy):
     # after there have been how many incorrect trials
     # should you move the opacity up?
     nUp = 10 - desired_accuracy * 10
@@ -11,26 +20,28 @@ def new_staircase(desired_accuracy):
     # move the opacity down?
     nDown = desired_accuracy * 10
 
-    starting_opacity = 0.8
-    staircase = StairHandler(starting_opacity,
-            nReversals = 4, stepSizes = [0.2, 0.1, 0.06, 0.03], stepType = 'lin',
-            nTrials = 100, nUp = nUp, nDown = nDown,
-            minVal = 0.01, maxVal = 1.0)
+    return nUp, nDown
+
+def new_staircase(desired_accuracy):
+    from psychopy.data import StairHandler
+
+    nUp, nDown = up_down_rule(desired_accuracy)
+    staircase = StairHandler(nUp = nUp, nDown = nDown, **STAIRCASE_SETTINGS)
 
     return staircase
 
 def simulate_trials(staircase, answers):
     for opacity in staircase:
         trial_n = staircase.thisTrialN
-        print 'Running trial {} with opacity: {}'.format(trial_n, opacity)
+        print('Running trial {} with opacity: {}'.format(trial_n, opacity))
 
         graded = answers[trial_n]
-        print 'Got {} response: {}'.format({1:'incorrect', 0:'correct'}[graded], graded)
+        print('Got {} response: {}'.format({1:'incorrect', 0:'correct'}[graded], graded))
 
         staircase.addResponse(graded)
 
-    print 'Final opacity = {}'.format(staircase.intensities[-1])
-    print 'Final accuracy = {}'.format(np.array(answers).mean())
+    print('Final opacity = {}'.format(staircase.intensities[-1]))
+    print('Final accuracy = {}'.format(np.array(answers).mean()))
 
 #all_correct_answers = [1 for _ in range(100)]
 #staircase = new_staircase(0.5)
@@ -42,20 +53,269 @@ def simulate_real_threshold(staircase, opacity_cutoff):
         graded = 1 if opacity > opacity_cutoff else 0
 
         if np.random.rand() >= 0.9:  # flip on 10% of trials
-            print 'unhelpful trial'
+            print('unhelpful trial')
             graded = 1 if graded == 0 else 0
 
-        print 'Running trial {} with opacity {}: got response {}'.format(
-            trial_n, opacity, graded)
+        print('Running trial {} with opacity {}: got response {}'.format(
+            trial_n, opacity, graded))
 
         staircase.addResponse(graded)
 
-    print 'Final opacity = {}'.format(np.array(staircase.intensities[-10:]).mean())
-    print 'Final accuracy = {}'.format(np.array(staircase.data).mean())
+    print('Final opacity = {}'.format(np.array(staircase.intensities[-10:]).mean()))
+    print('Final accuracy = {}'.format(np.array(staircase.data).mean()))
 
 #staircase = new_staircase(desired_accuracy = 0.9)
 #simulate_real_threshold(staircase, opacity_cutoff = 0.5)
 
+def psychometric(opacity, threshold=0.5, slope=20.0, guess_rate=0.25,
+                 lapse_rate=0.1):
+    """ Probability of a correct response at each opacity.
+
+    A logistic function of opacity that goes from guess_rate to
+    1 - lapse_rate. Any argument can be an array, e.g., a threshold for
+    each simulated participant.
+    """
+    p_seen = 1.0 / (1.0 + np.exp(-slope * (opacity - threshold)))
+    return guess_rate + (1.0 - guess_rate - lapse_rate) * p_seen
+
+def simulate_staircases(desired_accuracy, n_staircases=1000, max_trials=500,
+                        n_final=10, seed=None, observer=psychometric,
+                        responses=None, **kwargs):
+    """ Run many independent staircases at once.
+
+    Each staircase follows the rules of psychopy's StairHandler with the
+    settings used by new_staircase: 1-up 1-down until the first reversal,
+    then nUp-up nDown-down, with the step size changing at each reversal,
+    until there have been nReversals reversals and at least nTrials trials.
+    Like StairHandler, the step on the trial of the first reversal still
+    follows the 1-up 1-down rule, and nReversals is raised to the number of
+    step sizes if there are more step sizes. All of the staircases take a
+    step on every trial, as arrays, with responses drawn from the observer.
+
+    Parameters
+    ----------
+    desired_accuracy: Passed to up_down_rule to get nUp and nDown.
+    n_staircases: Number of staircases to run.
+    max_trials: Staircases that haven't finished after this many trials
+        are stopped.
+    n_final: Number of trials at the end of each staircase averaged to get
+        its final opacity.
+    seed: Seed for the responses, or a numpy Generator to draw them from.
+    observer: Function of an array of opacities that gives the probability
+        of a correct response at each one. Keyword arguments that aren't
+        staircase settings are passed to the observer.
+    responses: Array of 1 for correct and 0 for incorrect with a row for
+        each staircase and a column for each trial, used instead of drawing
+        responses from the observer. n_staircases and max_trials are taken
+        from its shape.
+
+    Returns
+    -------
+    dict of arrays with one value per staircase: final_opacity,
+    n_reversals, trials_to_criterion (nan if the staircase didn't finish),
+    and accuracy. Also has the opacity on each trial as intensities, with
+    nan after a staircase finished.
+    """
+    settings = dict(STAIRCASE_SETTINGS)
+    for name in list(kwargs):
+        if name in settings:
+            settings[name] = kwargs.pop(name)
+    n_up, n_down = up_down_rule(desired_accuracy)
+    step_sizes = np.atleast_1d(np.asarray(settings['stepSizes'], dtype=float))
+    step_type = settings['stepType']
+    n_reversals_needed = max(settings['nReversals'] or 0, len(step_sizes))
+
+    if responses is not None:
+        responses = np.asarray(responses, dtype=bool)
+        n_staircases, max_trials = responses.shape
+    rng = random_state(seed)
+    shape = (n_staircases, )
+    intensity = np.full(shape, settings['startVal'], dtype=float)
+    step_size = np.full(shape, step_sizes[0])
+    direction = np.zeros(shape, dtype=int)  # 0 at the start, 1 up, -1 down
+    counter = np.zeros(shape, dtype=int)
+    last_result = np.zeros(shape, dtype=bool)
+    n_reversals = np.zeros(shape, dtype=int)
+    n_correct = np.zeros(shape, dtype=int)
+    finished_at = np.zeros(shape, dtype=int)
+    intensities = np.full((n_staircases, max_trials), np.nan)
+
+    for trial in range(max_trials):
+        active = finished_at == 0
+        if not active.any():
+            break
+        intensities[active, trial] = intensity[active]
+
+        if responses is not None:
+            correct = responses[:, trial]
+        else:
+            correct = rng.random_sample(n_staircases) < \
+                observer(intensity, **kwargs)
+        n_correct += correct & active
+
+        # Count runs of the same response
+        same = last_result == correct if trial > 0 else np.zeros(shape, bool)
+        counter = np.where(correct, np.where(same, counter + 1, 1),
+                           np.where(same, counter - 1, -1))
+        last_result = correct
+
+        # Step after every trial until the first reversal, including the
+        # trial of the first reversal
+        initial = n_reversals == 0
+        go_down = np.where(initial, correct, counter >= n_down)
+        go_up = np.where(initial, ~correct, counter <= -n_up)
+
+        reversal = (go_down & (direction == 1)) | (go_up & (direction == -1))
+        direction = np.where(go_down, -1, np.where(go_up, 1, direction))
+        n_reversals = n_reversals + (reversal & active)
+
+        done = ((n_reversals >= n_reversals_needed) &
+                (trial + 1 >= settings['nTrials']) & active)
+        finished_at[done] = trial + 1
+
+        # Step sizes change at each reversal
+        step_ix = np.minimum(n_reversals, len(step_sizes) - 1)
+        step_size = np.where(reversal, step_sizes[step_ix], step_size)
+
+        step = np.where(go_down, -step_size, np.where(go_up, step_size, 0.0))
+        if step_type == 'lin':
+            new_intensity = intensity + step
+        elif step_type == 'log':
+            new_intensity = intensity * 10.0**step
+        elif step_type == 'db':
+            new_intensity = intensity * 10.0**(step / 20.0)
+        else:
+            raise ValueError('unknown stepType %s' % step_type)
+        if settings['minVal'] is not None:
+            new_intensity = np.maximum(new_intensity, settings['minVal'])
+        if settings['maxVal'] is not None:
+            new_intensity = np.minimum(new_intensity, settings['maxVal'])
+
+        intensity = np.where(active, new_intensity, intensity)
+        counter = np.where(go_down | go_up, 0, counter)
+
+    n_trials = np.where(finished_at > 0, finished_at,
+                        (~np.isnan(intensities)).sum(axis=1))
+    final = np.array([intensities[i, max(n - n_final, 0):n].mean()
+                      for i, n in enumerate(n_trials)])
+
+    return dict(
+        final_opacity = final,
+        n_reversals = n_reversals,
+        trials_to_criterion = np.where(finished_at > 0, finished_at, np.nan),
+        accuracy = n_correct / n_trials.astype(float),
+        intensities = intensities,
+    )
+
+def sweep_staircases(grid, n_staircases=1000, seed=None, **kwargs):
+    """ Summarize simulated staircases for every combination in a grid.
+
+    Parameters
+    ----------
+    grid: Dict of names of simulate_staircases arguments, staircase
+        settings, or observer arguments to lists of values, e.g.,
+        {'desired_accuracy': [0.7, 0.8, 0.9], 'stepSizes': [[0.2, 0.1],
+        [0.1, 0.05]]}.
+    n_staircases: Number of staircases for each combination.
+    seed: Seed for the responses. Each combination uses the same seed.
+    kwargs: Arguments used for every combination.
+
+    Returns
+    -------
+    pandas.DataFrame with a row for each combination.
+    """
+    import pandas as pd
+
+    names = list(grid)
+    rows = []
+    for values in product(*[grid[name] for name in names]):
+        params = dict(kwargs, **dict(zip(names, values)))
+        result = simulate_staircases(n_staircases=n_staircases, seed=seed,
+                                     **params)
+        final = result['final_opacity']
+        trials = result['trials_to_criterion']
+        row = dict(zip(names, values))
+        row.update(
+            final_opacity_mean = final.mean(),
+            final_opacity_sd = final.std(),
+            final_opacity_q05 = np.percentile(final, 5),
+            final_opacity_q95 = np.percentile(final, 95),
+            n_reversals_mean = result['n_reversals'].mean(),
+            finished = np.mean(~np.isnan(trials)),
+            trials_to_criterion_median = np.median(trials[~np.isnan(trials)])
+                if (~np.isnan(trials)).any() else np.nan,
+            accuracy_mean = result['accuracy'].mean(),
+        )
+        rows.append(row)
+
+    summary = pd.DataFrame(rows)
+    stats = [col for col in summary.columns if col not in names]
+    return summary[names + stats]
+
+class Quest(object):
+    """ QUEST-style adaptive estimate of the opacity threshold.
+
+    The threshold is estimated with a posterior over a grid of candidate
+    thresholds, and each trial is run at the opacity expected to give the
+    target accuracy if the threshold were the posterior mean. The
+    likelihood of a correct and an incorrect response at every opacity on
+    the grid for every threshold is computed up front, so updating after a
+    trial is one multiply and one normalize of the posterior.
+    """
+    def __init__(self, prior_mean=0.5, prior_sd=0.25, target_accuracy=0.75,
+                 min_opacity=0.01, max_opacity=1.0, n_opacities=100,
+                 n_thresholds=200, slope=20.0, guess_rate=0.25,
+                 lapse_rate=0.02):
+        """
+        Parameters
+        ----------
+        prior_mean, prior_sd: Normal prior on the threshold.
+        target_accuracy: Accuracy to aim for on each trial.
+        min_opacity, max_opacity: Range of opacities and thresholds.
+        n_opacities, n_thresholds: Number of points on each grid.
+        slope, guess_rate, lapse_rate: Shape of the psychometric function.
+        """
+        self.opacities = np.linspace(min_opacity, max_opacity, n_opacities)
+        self.thresholds = np.linspace(min_opacity, max_opacity, n_thresholds)
+
+        # likelihood[correct][opacity] is the likelihood of each threshold
+        p_correct = psychometric(self.opacities[:, np.newaxis],
+                                 self.thresholds[np.newaxis, :],
+                                 slope, guess_rate, lapse_rate)
+        self.likelihood = np.array([1.0 - p_correct, p_correct])
+
+        prior = np.exp(-0.5 * ((self.thresholds - prior_mean) / prior_sd)**2)
+        self.posterior = prior / prior.sum()
+
+        # Opacity above threshold that gives the target accuracy
+        p_seen = (target_accuracy - guess_rate) / \
+            (1.0 - guess_rate - lapse_rate)
+        if not 0 < p_seen < 1:
+            raise ValueError('target_accuracy must be between the guess rate '
+                             'and 1 - lapse rate')
+        self._offset = np.log(p_seen / (1.0 - p_seen)) / slope
+
+    def _opacity_ix(self, opacity):
+        return int(np.abs(self.opacities - opacity).argmin())
+
+    def next_opacity(self):
+        """ Opacity for the next trial, on the grid of opacities. """
+        return float(self.opacities[self._opacity_ix(self.mean() +
+                                                     self._offset)])
+
+    def update(self, opacity, correct):
+        """ Update the posterior with the response to a trial. """
+        row = self.likelihood[int(bool(correct)), self._opacity_ix(opacity)]
+        self.posterior *= row
+        self.posterior /= self.posterior.sum()
+
+    def mean(self):
+        return float(np.dot(self.posterior, self.thresholds))
+
+    def sd(self):
+        deviations = (self.thresholds - self.mean())**2
+        return float(np.sqrt(np.dot(self.posterior, deviations)))
+
 # notes
 # - whether or not a staircase will work depends on the relative relationship
 #   between desired accuracy, step sizes, and number of trials
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from labtools.staircase import (simulate_staircases, up_down_rule,
+                                STAIRCASE_SETTINGS)
+
+# Responses and the intensities psychopy's StairHandler gave for them with
+# desired_accuracy=0.7 (3-up 7-down) and nTrials=10. In the first one, the
+# first reversal is an incorrect response on the third trial, and the
+# staircase still steps up on that trial.
+RESPONSES = [
+    [1, 1, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 1, 1],
+    [0, 0, 1, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1],
+]
+INTENSITIES = [
+    [0.8, 0.6, 0.4, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.6, 0.6, 0.6, 0.6, 0.6,
+     0.6, 0.6, 0.54, 0.54, 0.54, 0.54, 0.57, 0.57],
+    [0.8, 1.0, 1.0, 0.9, 0.9, 0.9, 0.96, 0.96, 0.96, 0.96, 0.96, 0.96,
+     0.96, 0.93, 0.93, 0.93, 0.93, 0.93, 0.93, 0.93, 0.93, 0.93],
+]
+
+
+def _stair_handler_intensities(responses, desired_accuracy, **settings):
+    from psychopy.data import StairHandler
+
+    n_up, n_down = up_down_rule(desired_accuracy)
+    staircase = StairHandler(nUp=n_up, nDown=n_down,
+                             **dict(STAIRCASE_SETTINGS, **settings))
+    intensities = []
+    for intensity, response in zip(staircase, responses):
+        intensities.append(intensity)
+        staircase.addResponse(int(response))
+    return intensities
+
+
+def test_simulate_staircases_steps_like_stair_handler():
+    result = simulate_staircases(0.7, responses=RESPONSES, nTrials=10)
+    np.testing.assert_allclose(result['intensities'], INTENSITIES)
+
+
+@pytest.mark.parametrize('desired_accuracy, settings', [
+    (0.8, {}),
+    (0.7, {'nTrials': 20}),
+    (0.9, {'stepSizes': [0.1], 'nReversals': 3, 'nTrials': 10}),
+    (0.5, {'stepType': 'log', 'stepSizes': [0.2, 0.1], 'startVal': 0.5,
+           'nTrials': 15}),
+])
+def test_simulate_staircases_matches_stair_handler(desired_accuracy,
+                                                   settings):
+    pytest.importorskip('psychopy.data')
+    rng = np.random.default_rng(0)
+    p_correct = rng.uniform(0.3, 0.95, size=(50, 1))
+    responses = (rng.random((50, 150)) < p_correct).astype(int)
+
+    result = simulate_staircases(desired_accuracy, responses=responses,
+                                 **settings)
+    for row, intensities in zip(responses, result['intensities']):
+        expected = _stair_handler_intensities(row, desired_accuracy,
+                                              **settings)
+        np.testing.assert_allclose(intensities[~np.isnan(intensities)],
+                                   expected)
@@ -0,0 +1,83 @@
+from itertools import product
+
+import pandas as pd
+import pytest
+
+from labtools.trials_functions import (iter_combinations, smart_shuffle,
+                                       OrderNotFoundError)
+
+
+def _satisfies(combination, names, relations):
+    ix = dict(zip(names, combination))
+    return all(sum(c*ix[name] for name, c in rel.items()) % num_levels == 0
+               for rel, num_levels in relations)
+
+
+@pytest.mark.parametrize('conditions, relation, moduli', [
+    # 2 has no inverse mod 4, so the relation is checked, not solved
+    ({'a': range(4), 'b': range(4)}, {'a': 2, 'b': 2}, [4]),
+    ({'a': range(4), 'b': range(4), 'c': range(4)},
+     [{'a': 2, 'b': 2}, {'b': 2, 'c': 2}], [4, 4]),
+    # The relation over a and b is solved, and the one over c and d, with
+    # a different number of values, is checked
+    ({'a': range(3), 'b': range(3), 'c': range(6), 'd': range(6)},
+     [{'a': 1, 'b': 1}, {'c': 3, 'd': 3}], [3, 6]),
+    ({'c': range(6), 'd': range(6), 'a': range(4), 'b': range(4)},
+     [{'c': 2, 'd': 2}, {'a': 2, 'b': 2}], [6, 4]),
+])
+def test_iter_combinations_filters_relations(conditions, relation, moduli):
+    names = list(conditions)
+    relations = [relation] if isinstance(relation, dict) else relation
+    expected = [combination for combination
+                in product(*[conditions[name] for name in names])
+                if _satisfies(combination, names, zip(relations, moduli))]
+    combinations = list(iter_combinations(conditions, relation=relation))
+    assert sorted(combinations) == expected
+
+
+def _trials(valid_left, valid_right, invalid):
+    """ Valid trials to the left and right, and invalid trials up and
+    down, like a block of the spatial cueing experiment. """
+    rows = ([('valid', 'left')] * valid_left +
+            [('valid', 'right')] * valid_right +
+            [('invalid', 'up'), ('invalid', 'down')] * (invalid // 2))
+    return pd.DataFrame(rows, columns=['cue_validity', 'target_loc'])
+
+
+def _longest_run(values):
+    longest = run = 1
+    for previous, value in zip(values, values[1:]):
+        run = run + 1 if value == previous else 1
+        longest = max(longest, run)
+    return longest
+
+
+def test_smart_shuffle_limits_runs():
+    trials = _trials(valid_left=34, valid_right=30, invalid=36)
+    for seed in range(10):
+        shuffled = smart_shuffle(trials, {'target_loc': 1, 'cue_validity': 2},
+                                 seed=seed)
+        assert sorted(shuffled.index) == list(range(len(trials)))
+        assert _longest_run(shuffled.target_loc.tolist()) == 1
+        assert _longest_run(shuffled.cue_validity.tolist()) <= 2
+
+
+def test_smart_shuffle_raises_if_no_order_exists():
+    # Every run of valid trials has at most one valid-right trial, and
+    # 32 invalid trials only separate 33 runs
+    trials = _trials(valid_left=28, valid_right=36, invalid=32)
+    with pytest.raises(ValueError, match='no order exists') as error:
+        smart_shuffle(trials, {'target_loc': 1, 'cue_validity': 2}, seed=0,
+                      lim=10)
+    assert not isinstance(error.value, OrderNotFoundError)
+
+
+def test_smart_shuffle_tells_giving_up_from_no_order():
+    # An order exists, but the search backtracks to find it
+    trials = pd.DataFrame([(0, 0), (0, 1), (2, 1), (1, 0), (0, 1), (2, 0),
+                           (2, 2), (1, 1), (1, 2)], columns=['a', 'b'])
+    with pytest.raises(OrderNotFoundError):
+        smart_shuffle(trials, ['a', 'b'], seed=0, lim=0)
+    shuffled = smart_shuffle(trials, ['a', 'b'], seed=0)
+    assert _longest_run(shuffled.a.tolist()) == 1
+    assert _longest_run(shuffled.b.tolist()) == 1
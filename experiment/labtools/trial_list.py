@@ -1,10 +1,232 @@
-from collections import namedtuple
+from collections import OrderedDict
 
-from UserList import UserList
+import numpy as np
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+class Trial(object):
+    """ A view of one row of a TrialList.
+
+    Fields are read from and written to the columns of the trial list, so
+    values set on a trial are kept in the list. Like a namedtuple, a trial
+    has _fields and _asdict, and iterating over it gives its values.
+    """
+    __slots__ = ('_trials', '_ix')
+
+    def __init__(self, trials, ix):
+        object.__setattr__(self, '_trials', trials)
+        object.__setattr__(self, '_ix', ix)
+
+    @property
+    def _fields(self):
+        return self._trials.fields
+
+    def __getattr__(self, name):
+        try:
+            return self._trials.get(self._ix, name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        try:
+            self._trials.set(self._ix, name, value)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        for name in self._trials.fields:
+            yield self._trials.get(self._ix, name)
+
+    def __len__(self):
+        return len(self._trials.fields)
+
+    def __repr__(self):
+        values = ', '.join('%s=%r' % item for item in self._asdict().items())
+        return 'Trial(%s)' % values
+
+    def _asdict(self):
+        return OrderedDict(zip(self._trials.fields, self))
+
+    def _update(self, values):
+        """ Set many fields from a dict. """
+        for name, value in values.items():
+            setattr(self, name, value)
+
+def _can_hold(column, value):
+    """ Return the column, converted if it can't hold the value. """
+    if column.dtype == object:
+        return column
+    value_dtype = np.asarray(value).dtype
+    if value_dtype.kind in 'biuf':
+        if np.can_cast(value_dtype, column.dtype):
+            return column
+        return column.astype(np.result_type(column.dtype, value_dtype))
+    return column.astype(object)
+
+class TrialList(object):
+    """ Trials stored as columns.
+
+    Numeric columns are numpy arrays of their own dtype. Columns of strings
+    are stored as integer codes into a list of levels. Numeric columns can
+    be made empty, e.g., for data measured at runtime, and values that
+    haven't been set are read and written as ''. Indexing or iterating over
+    a trial list gives Trial views of the rows.
+    """
+    def __init__(self, columns, levels=None, unset=None):
+        """
+        Parameters
+        ----------
+        columns: OrderedDict of column names to numpy arrays. Columns in
+            levels hold integer codes.
+        levels: Dict of column names to the values of their codes.
+        unset: Dict of column names to boolean arrays that are True for
+            the rows that haven't been set.
+        """
+        self.fields = list(columns.keys())
+        self._columns = dict(columns)
+        self._levels = {name: list(values)
+                        for name, values in (levels or {}).items()}
+        self._codes = {name: {value: code for code, value in enumerate(values)}
+                       for name, values in self._levels.items()}
+        self._unset = {name: np.array(mask, dtype=bool)
+                       for name, mask in (unset or {}).items()}
+        lengths = set(len(column) for column in self._columns.values())
+        if len(lengths) > 1:
+            raise ValueError('columns have different lengths')
+        self._length = lengths.pop() if lengths else 0
 
-class TrialList(UserList):
     @classmethod
     def from_dataframe(cls, dataframe):
-        Trial = namedtuple('Trial', dataframe.columns)
-        data = [Trial(*trial[1:]) for trial in dataframe.itertuples()]
-        return cls(data)
+        columns = OrderedDict()
+        levels = {}
+        for name in dataframe.columns:
+            values = dataframe[name].values
+            if values.dtype.kind not in 'biuf':
+                from pandas import factorize
+                codes, uniques = factorize(values)
+                columns[name] = codes.astype(_code_dtype(len(uniques)))
+                levels[name] = list(uniques)
+            else:
+                columns[name] = values.copy()
+        return cls(columns, levels)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """ Create a trial list without pandas.
+
+        columns is an OrderedDict of column names to sequences of values.
+        """
+        arrays = OrderedDict()
+        levels = {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind in 'biuf':
+                arrays[name] = values
+                continue
+            uniques = OrderedDict()
+            codes = [uniques.setdefault(value, len(uniques))
+                     for value in values.tolist()]
+            arrays[name] = np.array(codes, dtype=_code_dtype(len(uniques)))
+            levels[name] = list(uniques)
+        return cls(arrays, levels)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            columns = OrderedDict((name, self._columns[name][ix])
+                                  for name in self.fields)
+            unset = {name: mask[ix] for name, mask in self._unset.items()}
+            return type(self)(columns, self._levels, unset)
+        if ix < 0:
+            ix += self._length
+        if not 0 <= ix < self._length:
+            raise IndexError('trial index out of range')
+        return Trial(self, ix)
+
+    def __iter__(self):
+        for ix in range(self._length):
+            yield Trial(self, ix)
+
+    def get(self, ix, name):
+        if name in self._unset and self._unset[name][ix]:
+            return ''
+        value = self._columns[name][ix]
+        if name in self._levels:
+            return self._levels[name][value]
+        return value.item() if hasattr(value, 'item') else value
+
+    def set(self, ix, name, value):
+        if name in self._unset:
+            self._unset[name][ix] = False
+        if name in self._levels:
+            if isinstance(value, string_types):
+                code = self._codes[name].get(value)
+                if code is None:
+                    code = self._add_level(name, value)
+                self._columns[name][ix] = code
+                return
+            # Only strings are stored as codes
+            self._decode(name)
+
+        column = _can_hold(self._columns[name], value)
+        column[ix] = value
+        self._columns[name] = column
+
+    def column(self, name, start=0, stop=None):
+        """ Get the values of a column, or the rows from start to stop,
+        as a list. """
+        values = self._columns[name][start:stop]
+        if name in self._levels:
+            return [self._levels[name][code] for code in values.tolist()]
+        values = values.tolist()
+        if name in self._unset:
+            unset = self._unset[name][start:stop].tolist()
+            values = ['' if is_unset else value
+                      for value, is_unset in zip(values, unset)]
+        return values
+
+    def set_empty(self, name, dtype=float):
+        """ Replace or add a numeric column with no values set.
+
+        Floats are stored as NaN and other dtypes as 0 until they are set.
+        """
+        if name not in self._columns:
+            self.fields.append(name)
+        self._levels.pop(name, None)
+        self._codes.pop(name, None)
+        dtype = np.dtype(dtype)
+        fill = np.nan if dtype.kind == 'f' else 0
+        self._columns[name] = np.full(self._length, fill, dtype=dtype)
+        self._unset[name] = np.ones(self._length, dtype=bool)
+
+    def header(self, sep=','):
+        return sep.join(self.fields) + '\n'
+
+    def write(self, data_file, start=0, stop=None, sep=','):
+        """ Write rows from start to stop as lines of text. """
+        stop = self._length if stop is None else stop
+        columns = [self.column(name, start, stop) for name in self.fields]
+        data_file.write(''.join(sep.join(map(str, row)) + '\n'
+                                for row in zip(*columns)))
+
+    def _add_level(self, name, value):
+        code = len(self._levels[name])
+        self._levels[name].append(value)
+        self._codes[name][value] = code
+        self._columns[name] = _can_hold(self._columns[name], code)
+        return code
+
+    def _decode(self, name):
+        """ Store a column of codes as the values themselves. """
+        self._columns[name] = np.array(self.column(name) + [None],
+                                       dtype=object)[:-1]
+        del self._levels[name]
+        del self._codes[name]
+
+def _code_dtype(n_levels):
+    return np.min_scalar_type(max(n_levels - 1, 0))
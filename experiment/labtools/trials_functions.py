@@ -4,36 +4,224 @@ labtools.trials_functions
 """
 import pandas as pd
 
-from numpy.random import RandomState
-from itertools import product
+from numpy import arange, empty, lexsort
 
-def counterbalance(conditions, order=None):
+from .rng import random_state
+from collections import OrderedDict
+from itertools import islice, product
+
+class OrderNotFoundError(ValueError):
+    """
+    No order was found within the limit on backtracks. Unlike the
+    ValueError raised when no order exists, an order may still be found
+    with a higher limit or another seed.
+    """
+
+def _as_levels(conditions):
+    """
+    Copy conditions, making sure that every variable has a list of values.
+    
+    :param dict conditions: Variable names and possible values.
+    :rtype: collections.OrderedDict
+    """
+    levels = OrderedDict()
+    for k,v in conditions.items():
+        if isinstance(v, str) or not hasattr(v, '__iter__'):
+            v = [v]
+        levels[k] = list(v)
+    return levels
+
+def _solve_relations(levels, relation):
+    """
+    Split a defining relation into variables to solve for and filters.
+    
+    A relation is a dict of variable names to integer coefficients, and
+    holds for a combination when the sum of each coefficient times the index
+    of the variable's value is divisible by the number of values. Variables
+    in a relation must have the same number of values. A relation can be
+    solved for a variable whose coefficient has an inverse modulo the number
+    of values and that isn't in any other relation.
+    
+    :return: List of (name, coefficients, inverse) for solved variables, and
+        a list of relations to check.
+    :rtype: tuple
+    """
+    if relation is None:
+        return [], []
+    relations = [relation] if isinstance(relation, dict) else list(relation)
+    
+    solved, filters = [], []
+    for i, rel in enumerate(relations):
+        num_levels = set(len(levels[name]) for name in rel)
+        if len(num_levels) != 1:
+            raise ValueError('variables in a relation must have the same '
+                             'number of values: %s' % sorted(rel))
+        num_levels = num_levels.pop()
+        
+        others = set()
+        for j, other in enumerate(relations):
+            if j != i:
+                others.update(other)
+        
+        for name in reversed(list(levels)):
+            if name not in rel or name in others:
+                continue
+            inverse = [x for x in range(num_levels)
+                       if (rel[name]*x) % num_levels == 1]
+            if inverse:
+                solved.append((name, rel, inverse[0]))
+                break
+        else:
+            filters.append(rel)
+    
+    return solved, filters
+
+def iter_combinations(conditions, where=None, relation=None):
+    """
+    Lazily generate combinations of independent variables.
+    
+    Combinations are made one at a time, so that large designs can be
+    filtered without making every combination first.
+    
+    A fractional factorial design keeps the combinations that satisfy a
+    defining relation. For variables with `k` values each, the relation
+    `{'a': 1, 'b': 1, 'c': -1}` keeps combinations where the indices of the
+    values satisfy `a + b - c = 0 (mod k)`, which is a Latin square of `c`
+    over `a` and `b`. When possible, the relation is solved for one of the
+    variables instead of checked, so only the kept combinations are made.
+    
+    :param dict conditions: Variable names and possible values. Values can be
+        of length 1.
+    :param where: Constraints that combinations must satisfy. Each is called
+        with a dict of variable names and values and returns a bool.
+    :type where: function, list of functions, or None
+    :param relation: Defining relations for a fractional factorial design.
+    :type relation: dict, list of dicts, or None
+    :return: Yields combinations as tuples in the order of `conditions`.
+    :rtype: tuple
+    """
+    levels = _as_levels(conditions)
+    names = list(levels)
+    
+    if where is None:
+        where = []
+    elif callable(where):
+        where = [where,]
+    
+    solved, filters = _solve_relations(levels, relation)
+    solved_names = set(name for name, _, _ in solved)
+    # Variables in a relation have the same number of values
+    filters = [(rel, len(levels[next(iter(rel))])) for rel in filters]
+    free = [name for name in names if name not in solved_names]
+    
+    for free_ix in product(*[range(len(levels[name])) for name in free]):
+        ix = dict(zip(free, free_ix))
+        
+        for name, rel, inverse in solved:
+            num_levels = len(levels[name])
+            rest = sum(c*ix[other] for other, c in rel.items() if other != name)
+            ix[name] = (-rest*inverse) % num_levels
+        
+        if any(sum(c*ix[name] for name, c in rel.items()) % num_levels
+               for rel, num_levels in filters):
+            continue
+        
+        values = dict((name, levels[name][ix[name]]) for name in names)
+        if all(constraint(values) for constraint in where):
+            yield tuple(values[name] for name in names)
+
+def iter_counterbalance(conditions, chunksize=10000, order=None, where=None,
+                        relation=None):
+    """
+    Generate combinations of independent variables in chunks.
+    
+    See :func:`iter_combinations` for the arguments that select combinations.
+    
+    :param dict conditions: Variable names and possible values.
+    :param int chunksize: Max number of rows in each chunk.
+    :param order: Optional order of columns in output.
+    :type order: list or None
+    :return: Yields frames of combinations. The index continues from one
+        chunk to the next.
+    :rtype: pandas.DataFrame
+    """
+    levels = _as_levels(conditions)
+    columns = list(levels)
+    if order is None:
+        order = columns
+    
+    combinations = iter_combinations(levels, where, relation)
+    start = 0
+    while True:
+        chunk = list(islice(combinations, chunksize))
+        if not chunk:
+            break
+        index = arange(start, start + len(chunk))
+        yield pd.DataFrame(chunk, columns=columns, index=index)[order]
+        start += len(chunk)
+
+def counterbalance(conditions, order=None, where=None, relation=None):
     """
     Generate all independent variable combinations in a DataFrame.
     
     Each row of the resulting DataFrame contains a unique combination of 
     conditions. Use primarily for full counterbalancing of within-subject 
-    variables.
+    variables. Combinations can be limited to those meeting constraints or
+    to a fraction of the full design; see :func:`iter_combinations`.
     
     :param dict conditions: Variable names and possible values. Values can be
         of length 1.
     :param order: Optional order of columns in output.
     :type order: list or None
+    :param where: Constraints that combinations must satisfy.
+    :type where: function, list of functions, or None
+    :param relation: Defining relations for a fractional factorial design.
+    :type relation: dict, list of dicts, or None
     :return: Each row is a unique combination of input variables, assuming the 
         possible values for each variable are unique.
     :rtype: pandas.DataFrame
     """
-    for k,v in conditions.items():
-        if not hasattr(v, '__iter__'):
-            conditions[k] = [v]
-    
-    combinations = list(product(*conditions.values()))
-    frame = pd.DataFrame(combinations, columns=conditions.keys())
+    levels = _as_levels(conditions)
+    combinations = list(iter_combinations(levels, where, relation))
+    frame = pd.DataFrame(combinations, columns=list(levels))
     
     if order is None:
         order = frame.columns
     
     return frame[order]
+
+def latin_square(n, balanced=True):
+    """
+    Orders of `n` conditions in which each condition appears once in each
+    position.
+    
+    Give each participant (or block) one of the rows. A balanced (Williams)
+    square also has each condition follow every other condition equally
+    often; when `n` is odd that takes `2*n` rows.
+    
+    :param int n: Number of conditions.
+    :param bool balanced: Should carryover effects be balanced? Defaults to
+        True.
+    :return: Rows of condition indices.
+    :rtype: list
+    """
+    if not balanced:
+        return [[(row + col) % n for col in range(n)] for row in range(n)]
+    
+    # First row goes 0, 1, n-1, 2, n-2, ...
+    first = [0]
+    low, high = 1, n - 1
+    while len(first) < n:
+        first.append(low)
+        low += 1
+        if len(first) < n:
+            first.append(high)
+            high -= 1
+    
+    rows = [[(x + row) % n for x in first] for row in range(n)]
+    if n % 2:
+        rows += [list(reversed(r)) for r in rows]
+    return rows
     
 def expand(valid, name, values=[1,0], ratio=0.5, sample=False, seed=None):
     """
@@ -50,13 +238,13 @@ def expand(valid, name, values=[1,0], ratio=0.5, sample=False, seed=None):
         frame. Must be between 0 and 1. Defaults to 0.5.
     :param bool sample: Should the invalid trials be sampled from the valid 
         trials? If True, len(returned) < 2*len(valid). Defaults to False.
-    :param seed: Seed random number generator.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from.
+    :type seed: int, numpy.random.Generator, or None
     :return: New trial list with valid and invalid trials are denoted in a 
         new column.
     :rtype: pandas.DataFrame
     """
-    prng = RandomState(seed)
+    prng = random_state(seed)
     num_trials = len(valid)
     
     if not sample:
@@ -110,45 +298,67 @@ def extend(frame, reps=None, max_length=None, rep_ix=None, row_ix=None):
     repeated = pd.concat([frame]*len(reps), keys=reps, names=col_names).reset_index()
     return repeated.drop(to_drop, axis=1)
 
-def add_block(frame, size, name='block', start_at=0, id_col=None, seed=None):
+def add_block(frame, size, name='block', start_at=0, id_col=None, seed=None,
+              report=False):
     """
     Creates a new column for block.
     
+    Trials are dealt out to blocks like cards. Trials are grouped into cells
+    by the values in `id_col`, put in random order within each cell, and
+    then dealt to the blocks in turn, continuing from one cell to the next.
+    Each block gets the floor or the ceiling of its share of every cell,
+    and block lengths differ by at most one trial.
+    
     :param pandas.DataFrame frame: Trials to be assigned blocks.
     :param int size: Length of each block.
-    :param id_col: Column to group by before blocking. Assures that blocks 
+    :param str name: Name of the new column. Defaults to 'block'.
+    :param int start_at: Number of the first block. Defaults to 0.
+    :param id_col: Columns to group by before blocking. Assures that blocks 
         consist of approximately the same number of trials for each unique
-        value in id_col
-    :type id_col: str or None
-    :param seed: Seed random number generator.
-    :type seed: int or None
-    :returns: Trial list with new column for block.
-    :rtype: pandas.DataFrame
+        combination of values in id_col, e.g., `['cue_validity', 'cue_type',
+        'target_loc']`.
+    :type id_col: str, list, or None
+    :param seed: Seed random number generator, or a generator to draw from.
+    :type seed: int, numpy.random.Generator, or None
+    :param bool report: Should the number of trials in each cell of each
+        block be returned? Defaults to False.
+    :returns: Trial list with new column for block, sorted by block. If
+        `report` is True, also returns a frame of the counts in each block
+        (rows) and cell (columns).
+    :rtype: pandas.DataFrame or tuple
     """
-    def _assigner(blocks, prng):
-        prng.shuffle(blocks)
-        i = 0
-        while True:
-            yield blocks[i]
-            if (i+1)%len(blocks):
-                prng.shuffle(blocks)
-            i = (i+1)%len(blocks)
-            
-    prng = RandomState(seed)
-    blocks = range(len(frame)/size)
-    assigner = _assigner(blocks, prng)
-    
-    def _add(chunk):
-        chunk[name] = [assigner.next() for _ in xrange(len(chunk))]
-        return chunk
+    prng = random_state(seed)
+    num_trials = len(frame)
+    num_blocks = max(num_trials//size, 1)
     
     if id_col is None:
-        new_frame = _add(frame).sort(name)
+        id_cols = []
+    elif isinstance(id_col, str) or not hasattr(id_col, '__iter__'):
+        id_cols = [id_col,]
     else:
-        new_frame = frame.groupby(id_col).apply(_add).sort(name)
+        id_cols = list(id_col)
+    
+    # Order trials by cell, and randomly within each cell
+    cell_codes = [pd.factorize(frame[col])[0] for col in reversed(id_cols)]
+    dealing_order = lexsort([prng.random_sample(num_trials)] + cell_codes)
+    
+    # Deal to the blocks in a random order so that the first blocks don't
+    # always get the extra trials
+    block_order = prng.permutation(num_blocks)
+    blocks = empty(num_trials, dtype=int)
+    blocks[dealing_order] = block_order[arange(num_trials) % num_blocks]
+    
+    new_frame = frame.copy()
+    new_frame[name] = blocks + start_at
+    new_frame = new_frame.sort_values(name, kind='mergesort')
     
-    new_frame[name] = new_frame[name] + start_at
-    return new_frame
+    if not report:
+        return new_frame
+    
+    balance = new_frame.groupby([name] + id_cols).size()
+    if id_cols:
+        balance = balance.unstack(id_cols, fill_value=0)
+    return new_frame, balance
                 
 def simple_shuffle(frame, block=None, times=10, seed=None):
     """
@@ -158,12 +368,12 @@ def simple_shuffle(frame, block=None, times=10, seed=None):
     :param block: Optional column to groupby before shuffling.
     :type block: str or None.
     :param int times: Number of times to shuffle. Defaults to 10.
-    :param seed: Seed random number generator.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from.
+    :type seed: int, numpy.random.Generator, or None
     :returns: Trial list with rows in random order.
     :rtype: pandas.DataFrame
     """
-    prng = RandomState(seed)
+    prng = random_state(seed)
     
     def _shuffle(chunk):
         for _ in range(times):
@@ -175,39 +385,244 @@ def simple_shuffle(frame, block=None, times=10, seed=None):
     else:
         return frame.groupby(block).apply(_shuffle)
 
+def _max_in_run(length, max_run, run=0):
+    """
+    Max number of items with the same value in `length` consecutive items,
+    if the value can't repeat more than `max_run` times and the items
+    before them end with a run of `run` of the value.
+    """
+    num = 0
+    for _ in range(length):
+        if run < max_run:
+            num += 1
+            run += 1
+        else:
+            run = 0
+    return num
+
+def _no_repeat_order(keys, max_runs, prng, max_backtracks=10000,
+                     restart_after=100):
+    """
+    Order items so that no value repeats more than allowed.
+    
+    The order is built one item at a time. At each step, the next item is
+    drawn from the kinds that don't extend a run past its max and that
+    leave the rest of the items possible to order. Kinds that leave the
+    least room to spare in the counts below go first, so the scarce
+    separators aren't used up early, and kinds that leave the same room
+    are drawn at random, weighted by how many items of each kind are left.
+    
+    Whether the rest can be ordered is checked by counting. For a column
+    with max run `r`, `m` items left with value `v`, and `n` items left
+    with other values, the rest can be ordered only if `m <= r*n + s`,
+    where `s` is `r` less the length of the current run of `v`, or `r` if
+    the last item isn't a `v`. For a single column that is enough to never
+    get stuck. Columns also limit each other: the items with value `v`
+    come in at most `n + 1` runs of at most `r` items, and in each run,
+    another column with a shorter max run `q` can't have the same value
+    `w` more than `r - r//(q + 1)` times, which bounds the number of items
+    with both `v` and `w`. With several columns, dead ends are still
+    possible, and the last choices are undone until a different choice
+    works. Searches that undo more than `restart_after` choices start over
+    with new random choices, doubling the limit each time.
+    
+    :param list keys: Tuples of values, one for each item, with a value for
+        each constrained column.
+    :param list max_runs: Max number of consecutive items with the same value
+        in each column.
+    :param numpy.random.RandomState prng: Randomizer.
+    :param int max_backtracks: Max number of choices to undo, over all of
+        the restarts.
+    :param int restart_after: Number of choices to undo before the first
+        restart.
+    :return: Positions of the items in order, and the number of backtracks.
+    :rtype: tuple
+    :raises ValueError: If no order exists.
+    :raises OrderNotFoundError: If no order was found within
+        `max_backtracks`, although one may exist.
+    """
+    # Group items of the same kind, in order of first appearance so that
+    # the result doesn't depend on hashing
+    kinds = OrderedDict()
+    for position, key in enumerate(keys):
+        kinds.setdefault(tuple(key), []).append(position)
+    kind_keys = list(kinds)
+    remaining = [len(positions) for positions in kinds.values()]
+    num_cols = len(max_runs)
+    
+    counts = [{} for _ in range(num_cols)]
+    for key, num in zip(kind_keys, remaining):
+        for c in range(num_cols):
+            counts[c][key[c]] = counts[c].get(key[c], 0) + num
+    
+    # Counts of the pairs of values in columns c and d, where d has the
+    # shorter max run, and the most items with d's value in a run of c's
+    per_run = OrderedDict(((c, d), _max_in_run(max_runs[c], max_runs[d]))
+                          for c in range(num_cols) for d in range(num_cols)
+                          if max_runs[d] < max_runs[c])
+    pair_counts = {}
+    for key, num in zip(kind_keys, remaining):
+        for c, d in per_run:
+            pair = (c, d, key[c], key[d])
+            pair_counts[pair] = pair_counts.get(pair, 0) + num
+    
+    last = [None]*num_cols
+    run = [0]*num_cols
+    history = []
+    
+    def _slack(total):
+        """ Room to spare in the tightest count, negative if the rest of
+        the items can't be ordered. """
+        slack = total
+        for c in range(num_cols):
+            r = max_runs[c]
+            for value, num in counts[c].items():
+                room = r - run[c] if value == last[c] else r
+                slack = min(slack, room + r*(total - num) - num)
+        for (c, d, v, w), num in pair_counts.items():
+            if not num:
+                continue
+            others = total - counts[c][v]
+            if last[c] == v:
+                room = _max_in_run(max_runs[c] - run[c], max_runs[d],
+                                   run[d] if last[d] == w else 0)
+            else:
+                room = per_run[c, d]
+            slack = min(slack, room + per_run[c, d]*others - num)
+        return slack
+    
+    def _place(kind):
+        key = kind_keys[kind]
+        history.append((list(last), list(run)))
+        remaining[kind] -= 1
+        for c in range(num_cols):
+            counts[c][key[c]] -= 1
+            if last[c] == key[c]:
+                run[c] += 1
+            else:
+                last[c], run[c] = key[c], 1
+        for c, d in per_run:
+            pair_counts[c, d, key[c], key[d]] -= 1
+    
+    def _unplace(kind):
+        key = kind_keys[kind]
+        last[:], run[:] = history.pop()
+        remaining[kind] += 1
+        for c in range(num_cols):
+            counts[c][key[c]] += 1
+        for c, d in per_run:
+            pair_counts[c, d, key[c], key[d]] += 1
+    
+    def _candidates(total):
+        allowed = []
+        for kind, key in enumerate(kind_keys):
+            if not remaining[kind]:
+                continue
+            if any(last[c] == key[c] and run[c] >= max_runs[c]
+                   for c in range(num_cols)):
+                continue
+            _place(kind)
+            slack = _slack(total - 1)
+            if slack >= 0:
+                allowed.append((slack, kind))
+            _unplace(kind)
+        
+        # Least room to spare first, then weighted random order
+        # (Efraimidis and Spirakis)
+        weights = [-prng.random_sample()**(1.0/remaining[kind])
+                   for _, kind in allowed]
+        return [kind for _, _, kind in sorted(
+            (slack, weight, kind)
+            for (slack, kind), weight in zip(allowed, weights)
+        )]
+    
+    total = len(keys)
+    if _slack(total) < 0:
+        raise ValueError('no order exists: the trials can\'t be ordered '
+                         'within the max runs')
+    
+    sequence = []
+    options = [_candidates(total)] if total else []
+    backtracks = 0
+    restart_at = restart_after
+    while len(sequence) < total:
+        if options[-1]:
+            kind = options[-1].pop(0)
+            _place(kind)
+            sequence.append(kind)
+            if len(sequence) < total:
+                options.append(_candidates(total - len(sequence)))
+        else:
+            options.pop()
+            if not sequence:
+                raise ValueError('no order exists: the trials can\'t be '
+                                 'ordered within the max runs')
+            backtracks += 1
+            if backtracks > max_backtracks:
+                raise OrderNotFoundError('no order found in %d backtracks' %
+                                         max_backtracks)
+            _unplace(sequence.pop())
+            if backtracks >= restart_at:
+                # Start over rather than keep searching a bad beginning
+                restart_after *= 2
+                restart_at = backtracks + restart_after
+                while sequence:
+                    _unplace(sequence.pop())
+                options = [_candidates(total)]
+    
+    # Items of the same kind are interchangeable, so deal them out in
+    # random order
+    positions = [list(prng.permutation(kinds[key])) for key in kind_keys]
+    order = [positions[kind].pop() for kind in sequence]
+    return order, backtracks
+
 def smart_shuffle(frame, col, block=None, seed=None, verbose=False, lim=10000):
     """
     Shuffles trials such that equivalent trials never appear back to back.
     
+    Trials are put in order one at a time, only ever choosing trials that
+    keep a valid order possible, so there is no need to try many random
+    permutations. See :func:`_no_repeat_order` for details.
+    
     :param pandas.DataFrame frame: Trials to be shuffled.
-    :param str col: Column of values to minimize repetitions.
+    :param col: Columns of values to limit repetitions. If `col` is a dict,
+        keys are columns and values are the max number of consecutive trials
+        that can have the same value, e.g., `{'target_loc': 1,
+        'cue_validity': 2}`. Otherwise, values can't repeat at all.
+    :type col: str, list, or dict
     :param block: Column to groupby before shuffling.
     :type block: str or None
-    :param seed: Seed random number generator.
-    :type seed: int or None
+    :param seed: Seed random number generator, or a generator to draw from.
+    :type seed: int, numpy.random.Generator, or None
     :param bool verbose: Should the status of randomization be printed? Defaults
         to False.
-    :param int lim: Maximum number of shuffles before giving up. Defaults to
+    :param int lim: Maximum number of backtracks before giving up. Defaults to
         10000.
     :returns: Trial list with rows in randomized order.
     :rtype: pandas.DataFrame
+    :raises ValueError: If the trials can't be ordered without repeats.
+    :raises OrderNotFoundError: A subclass of ValueError, if the search gave
+        up after `lim` backtracks. An order may still exist, so try again
+        with a higher `lim` or another seed.
     """
-    prng = RandomState(seed)
-        
+    prng = random_state(seed)
+    
+    if not isinstance(col, dict):
+        if isinstance(col, str) or not hasattr(col, '__iter__'):
+            col = [col,]
+        col = OrderedDict((c, 1) for c in col)
+    cols = sorted(col)
+    max_runs = [col[c] for c in cols]
+    
     def _shuffle(chunk):
         orig_index = chunk.index
-        repeats = None
-        for i in xrange(lim):
-            new = chunk.reindex(prng.permutation(chunk.index))
-            r = (new[col][1:]==new[col][:-1]).sum()
-            if repeats is None or r < repeats:
-                repeats = r
-                chunk = new
-            if repeats == 0:
-                break
-        if i==lim-1 and verbose:
-            print 'Iteration limit reached! Minimum repeats: ', str(repeats)
+        keys = list(zip(*[chunk[c].tolist() for c in cols]))
+        order, backtracks = _no_repeat_order(keys, max_runs, prng, lim)
+        if verbose:
+            print('Ordered %d trials with %d backtracks' %
+                  (len(chunk), backtracks))
         
+        chunk = chunk.iloc[order]
         chunk.index = orig_index
         return chunk
     
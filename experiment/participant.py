@@ -1,6 +1,27 @@
+import os
+
 from labtools.participant import Participant
 
+from trial_list import CUE_CONTRASTS
+from seed_search import lookup_seed
+
+# Best seeds for each condition made by seed_search.py
+BEST_SEEDS = 'best_seeds.csv'
+
 class SpatialCueingParticipant(Participant):
+    def get_subj_info(self):
+        """ Get the participant's info from the dialog.
+
+        If there is a best seeds file, the seed entered in the dialog is
+        the rank of a seed in the list for the participant's condition,
+        and the participant is given that seed.
+        """
+        Participant.get_subj_info(self)
+        if os.path.exists(BEST_SEEDS):
+            self['seed_rank'] = int(self['seed'])
+            self['seed'] = lookup_seed(BEST_SEEDS, self['cue_contrast'],
+                                       self['mask_type'], self['seed_rank'])
+
     def get_trial_list_kwargs(self):
         """ Get a subset of variables to pass to the trial list creator. """
         keys_to_copy = ['subj_id', 'seed', 'experimenter', 'sona_experiment_code',
@@ -8,8 +29,6 @@ class SpatialCueingParticipant(Participant):
         kwargs = {k: self[k] for k in keys_to_copy}
 
         # Interpret any signifiers here
-        cue_contrast_map = {'word_arrow': ['visual_word', 'visual_arrow'],
-                            'visual_auditory': ['visual_word', 'auditory_word']}
-        kwargs['cue_type'] = cue_contrast_map[self['cue_contrast']]
+        kwargs['cue_type'] = CUE_CONTRASTS[self['cue_contrast']]
 
         return kwargs
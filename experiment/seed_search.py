@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+""" Search for seeds that make well balanced trial lists.
+
+Trial lists are drawn at random from the participant's seed, so some seeds
+give lists with, e.g., practice trials that are mostly on one side, or a
+block with most of the catch trials. This scores candidate seeds against
+the balance criteria in seed_criteria.yaml in a pool of processes, and
+writes the best seeds for each condition so that participants can be
+given seeds from the list instead of finding out afterwards. When
+best_seeds.csv exists, the experiment asks for the rank of a seed in the
+list instead of the seed itself (see participant.py).
+
+Trials are drawn as integer codes that only depend on the number of cue
+types and mask types, so every condition with the same design gets the
+same trials from a seed. Seeds are scored once for each design, and the
+criteria for cue_type and mask_type can't name their levels.
+
+    python seed_search.py --first-seed 100 --n-seeds 10000 --n-best 50
+
+Scores are cached in seed_scores.csv with a key for the criteria and the
+trial list and random number code, so seeds that have already been scored
+aren't scored again. Changing either starts a new set of scores.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from itertools import product
+
+import numpy as np
+import yaml
+
+from trial_list import (CUE_CONTRASTS, TARGET_LOCS, CUE_VALIDITIES, CUE_DIRS,
+                        draw_trials)
+from trial_bank import MASK_TYPES, generator_version
+SCORES_HEADER = 'criteria_key,n_cue_types,n_mask_types,seed,score\n'
+
+# Columns whose levels change with the condition
+CONDITION_COLUMNS = ['cue_type', 'mask_type']
+
+
+def load_criteria(criteria_yaml):
+    with open(criteria_yaml, 'r') as f:
+        criteria = yaml.safe_load(f)
+    for criterion in criteria:
+        proportions = criterion.get('proportions', 'balanced')
+        if (criterion['column'] in CONDITION_COLUMNS and
+                proportions != 'balanced'):
+            raise ValueError('proportions of %s must be balanced, since '
+                             'seeds are scored once for every condition '
+                             'with the same design' % criterion['column'])
+    return criteria
+
+
+def design(cue_contrast, mask_type):
+    """ The numbers of cue types and mask types, which are all that the
+    trials drawn for a condition depend on. A participant sees one mask
+    type. """
+    return len(CUE_CONTRASTS[cue_contrast]), 1
+
+
+def criteria_key(criteria):
+    """ Identify the criteria and the code that draws the trials, like the
+    version of a trial bank. """
+    key = hashlib.md5(json.dumps(criteria, sort_keys=True).encode('utf-8'))
+    key.update(generator_version().encode('utf-8'))
+    return key.hexdigest()[:12]
+
+
+def _levels(column, n_cue_types, n_mask_types):
+    return {
+        'target_loc': TARGET_LOCS,
+        'cue_validity': CUE_VALIDITIES,
+        'cue_dir': CUE_DIRS,
+        'cue_type': list(range(n_cue_types)),
+        'mask_type': list(range(n_mask_types)),
+    }[column]
+
+
+def _longest_run(codes):
+    if len(codes) == 0:
+        return 0
+    starts = np.flatnonzero(np.diff(codes)) + 1
+    bounds = np.concatenate([[0], starts, [len(codes)]])
+    return np.diff(bounds).max()
+
+
+def score_trials(trials, criteria, n_cue_types, n_mask_types):
+    """ Score the codes of a trial list. Lower is better. """
+    block = trials['block']
+    subsets = {
+        'practice': block == 0,
+        'test': block > 0,
+        'all': np.ones(len(block), dtype=bool),
+    }
+
+    score = 0.0
+    for criterion in criteria:
+        column = criterion['column']
+        levels = _levels(column, n_cue_types, n_mask_types)
+        selected = subsets[criterion.get('trials', 'all')]
+        if criterion.get('by'):
+            by = trials[criterion['by']]
+            groups = [selected & (by == value)
+                      for value in np.unique(by[selected])]
+        else:
+            groups = [selected]
+
+        penalties = []
+        for group in groups:
+            codes = trials[column][group]
+            if 'proportions' in criterion:
+                target = criterion['proportions']
+                if target == 'balanced':
+                    target = dict.fromkeys(levels, 1.0 / len(levels))
+                target = np.array([target.get(level, 0.0)
+                                   for level in levels])
+                observed = np.bincount(codes, minlength=len(levels))
+                observed = observed / float(max(len(codes), 1))
+                penalties.append(np.abs(observed - target).sum())
+            else:
+                longest = _longest_run(codes)
+                penalties.append(max(longest - criterion['max_run'], 0))
+
+        score += criterion.get('weight', 1.0) * float(np.mean(penalties))
+    return score
+
+
+def _score_seeds(args):
+    """ Score seeds for one design. Runs in the worker processes. """
+    (n_cue_types, n_mask_types), seeds, criteria = args
+    cue_type = list(range(n_cue_types))
+    mask_type = list(range(n_mask_types))
+    return [((n_cue_types, n_mask_types), seed,
+             score_trials(draw_trials(seed, cue_type, mask_type), criteria,
+                          n_cue_types, n_mask_types))
+            for seed in seeds]
+
+
+class ScoreCache(object):
+    """ Scores of seeds that have already been evaluated, for each
+    design. A file with a different header is replaced. """
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+        self.scores = {}
+        self._new_file = True
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self._new_file = next(f, None) != SCORES_HEADER
+                lines = [] if self._new_file else f
+                for line in lines:
+                    key, n_cue_types, n_mask_types, seed, score = \
+                        line.strip().split(',')
+                    if key == self.key:
+                        self.scores[((int(n_cue_types), int(n_mask_types)),
+                                     int(seed))] = float(score)
+
+    def __contains__(self, design_seed):
+        return design_seed in self.scores
+
+    def update(self, results):
+        """ Add ((n_cue_types, n_mask_types), seed, score) tuples and save
+        them. """
+        with open(self.filename, 'w' if self._new_file else 'a') as f:
+            if self._new_file:
+                f.write(SCORES_HEADER)
+                self._new_file = False
+            for (n_cue_types, n_mask_types), seed, score in results:
+                self.scores[((n_cue_types, n_mask_types), seed)] = score
+                f.write('%s,%d,%d,%d,%r\n' % (self.key, n_cue_types,
+                                               n_mask_types, seed, score))
+
+    def best(self, cue_contrast, mask_type, seeds, n_best):
+        """ The n_best (seed, score) pairs for a condition. """
+        key = design(cue_contrast, mask_type)
+        scored = [(self.scores[(key, seed)], seed) for seed in seeds]
+        return [(seed, score) for score, seed in sorted(scored)[:n_best]]
+
+
+def search(seeds, criteria, cue_contrasts=None, mask_types=None,
+           cache_file='seed_scores.csv', processes=None, chunksize=500):
+    """ Score seeds for the design of every condition, skipping seeds in
+    the cache.
+
+    Returns the ScoreCache with scores for all of the seeds.
+    """
+    seeds = list(seeds)
+    cue_contrasts = list(cue_contrasts or CUE_CONTRASTS)
+    mask_types = list(mask_types or MASK_TYPES)
+    cache = ScoreCache(cache_file, criteria_key(criteria))
+
+    designs = sorted(set(design(cue_contrast, mask_type)
+                         for cue_contrast, mask_type
+                         in product(cue_contrasts, mask_types)))
+    tasks = []
+    for key in designs:
+        to_score = [seed for seed in seeds if (key, seed) not in cache]
+        for start in range(0, len(to_score), chunksize):
+            tasks.append((key, to_score[start:start + chunksize], criteria))
+
+    if tasks:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for results in pool.imap_unordered(_score_seeds, tasks):
+                cache.update(results)
+        finally:
+            pool.close()
+            pool.join()
+
+    return cache
+
+
+def write_best_seeds(filename, cache, seeds, n_best, cue_contrasts=None,
+                     mask_types=None):
+    """ Write the best seeds for each condition, best first. Conditions
+    with the same design have the same seeds. """
+    with open(filename, 'w') as f:
+        f.write('cue_contrast,mask_type,rank,seed,score\n')
+        for cue_contrast, mask_type in product(cue_contrasts or CUE_CONTRASTS,
+                                               mask_types or MASK_TYPES):
+            best = cache.best(cue_contrast, mask_type, seeds, n_best)
+            for rank, (seed, score) in enumerate(best):
+                f.write('%s,%s,%d,%d,%r\n' % (cue_contrast, mask_type, rank,
+                                              seed, score))
+
+
+def lookup_seed(best_seeds_csv, cue_contrast, mask_type, rank):
+    """ Get the seed at rank for a condition from a best seeds file. """
+    with open(best_seeds_csv, 'r') as f:
+        next(f)  # header
+        for line in f:
+            row_contrast, row_mask, row_rank, seed, _ = line.strip().split(',')
+            if ((row_contrast, row_mask, int(row_rank)) ==
+                    (cue_contrast, mask_type, rank)):
+                return int(seed)
+    raise KeyError('no seed at rank %d for %s, %s' %
+                   (rank, cue_contrast, mask_type))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--first-seed', type=int, default=100)
+    parser.add_argument('--n-seeds', type=int, default=10000)
+    parser.add_argument('--n-best', type=int, default=50)
+    parser.add_argument('--cue-contrast', nargs='+',
+                        choices=list(CUE_CONTRASTS))
+    parser.add_argument('--mask-type', nargs='+', choices=MASK_TYPES)
+    parser.add_argument('--criteria', default='seed_criteria.yaml')
+    parser.add_argument('--cache', default='seed_scores.csv')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--output', default='best_seeds.csv')
+    args = parser.parse_args()
+
+    seeds = range(args.first_seed, args.first_seed + args.n_seeds)
+    criteria = load_criteria(args.criteria)
+    cache = search(seeds, criteria, args.cue_contrast, args.mask_type,
+                   cache_file=args.cache, processes=args.processes)
+    write_best_seeds(args.output, cache, seeds, args.n_best,
+                     args.cue_contrast, args.mask_type)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" Run simulated participants through the spatial cueing experiment.
+
+No window is opened and nothing waits in real time, so a whole session
+takes a fraction of a second. Use it to exercise the experiment and the
+data pipeline on a machine without a display, or without psychopy.
+
+    python simulate.py --n-sessions 100 --output simulations
+"""
+import argparse
+
+import unipath
+import yaml
+
+from labtools.data_writer import AsyncWriter
+from labtools.rng import RandomStreams
+from labtools.arrow_writer import ArrowWriter
+from labtools.simulation import Simulation, CueValidityResponder
+
+from spatial_cueing import SpatialCueingExperiment, run_session
+from trial_list import SpatialCueingTrialList, COLUMN_TYPES, CUE_CONTRASTS
+from trial_bank import TrialBank
+
+
+class SimulatedSpatialCueingExperiment(SpatialCueingExperiment):
+    """ The experiment with a Simulation in place of psychopy. """
+    def __init__(self, experiment_yaml, simulation, **kwargs):
+        self.simulation = simulation
+        SpatialCueingExperiment.__init__(self, experiment_yaml,
+                                         backend=simulation, **kwargs)
+
+    def run_trial(self, trial):
+        # Let the responder know which trial it's responding to
+        self.simulation.trial = trial
+        try:
+            return SpatialCueingExperiment.run_trial(self, trial)
+        finally:
+            self.simulation.trial = None
+
+
+def simulate_session(subj_id, seed, cue_contrast='word_arrow',
+                     mask_type='mask', responder=None, output_dir='.'):
+    """ Run a simulated participant and return the name of the data file.
+
+    If no responder is given, the participant is a CueValidityResponder
+    seeded with the participant's seed.
+    """
+    # The same info as participant.SpatialCueingParticipant, without
+    # bringing up the psychopy dialog
+    with open('participant.yaml', 'r') as f:
+        participant = yaml.safe_load(f)
+    trial_list_kwargs = dict(
+        subj_id=subj_id,
+        seed=seed,
+        experimenter='simulation',
+        sona_experiment_code=participant['sona_experiment_code'],
+        cue_contrast=cue_contrast,
+        mask_type=mask_type,
+        cue_type=CUE_CONTRASTS[cue_contrast],
+    )
+    streams = RandomStreams(seed)
+    bank = TrialBank.open_if_exists('trials.bank')
+    trial_list = SpatialCueingTrialList.from_kwargs(bank=bank,
+                                                    streams=streams,
+                                                    **trial_list_kwargs)
+
+    simulation = Simulation(responder or CueValidityResponder(seed=seed))
+    experiment = SimulatedSpatialCueingExperiment(
+        'experiment.yaml', simulation,
+        streams=streams,
+        cue_types=trial_list_kwargs['cue_type'],
+    )
+    experiment.show_instructions(mask_type=mask_type)
+
+    data_filename = unipath.Path(output_dir, subj_id + '.csv')
+    flips_filename = unipath.Path(output_dir, subj_id + '.flips')
+    arrow_filename = unipath.Path(output_dir, subj_id + '.arrow')
+    rng_filename = unipath.Path(output_dir, subj_id + '.rng.json')
+    arrow_file = ArrowWriter.open_if_available(arrow_filename, COLUMN_TYPES)
+    streams.write(rng_filename)
+    try:
+        with AsyncWriter(data_filename) as data_file, \
+                AsyncWriter(flips_filename, mode='wb') as flips_file:
+            run_session(experiment, trial_list, data_file, flips_file,
+                        arrow_file)
+    finally:
+        if arrow_file is not None:
+            arrow_file.close()
+        streams.write(rng_filename)
+
+    experiment.show_end_screen()
+    return data_filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-sessions', type=int, default=1)
+    parser.add_argument('--first-seed', type=int, default=1000)
+    parser.add_argument('--cue-contrast', default='word_arrow',
+                        choices=['word_arrow', 'visual_auditory'])
+    parser.add_argument('--mask-type', default='mask',
+                        choices=['mask', 'nomask'])
+    parser.add_argument('--output', default='simulations',
+                        help='directory for the simulated data files')
+    args = parser.parse_args()
+
+    output_dir = unipath.Path(args.output)
+    if not output_dir.exists():
+        output_dir.mkdir(parents=True)
+
+    for seed in range(args.first_seed, args.first_seed + args.n_sessions):
+        simulate_session('SIM%d' % seed, seed,
+                         cue_contrast=args.cue_contrast,
+                         mask_type=args.mask_type,
+                         output_dir=output_dir)
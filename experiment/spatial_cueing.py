@@ -1,17 +1,20 @@
-from collections import OrderedDict
-import random
 import yaml
 
 import unipath
 
-from psychopy import visual, core, event, sound
-
-from labtools.psychopy_helper import load_sounds
-from labtools.dynamicmask import DynamicMask
+from labtools.psychopy_helper import load_sounds, stimuli
+from labtools.dynamicmask import DynamicMask, MaskArray, load_noise_atlas
 from labtools.experiment import Experiment
+from labtools.frame_plan import FramePlan, to_n_frames, measure_fps
+from labtools.flip_timing import FlipRecorder
+from labtools.data_writer import AsyncWriter
+from labtools.arrow_writer import ArrowWriter
+from labtools.keyboard import Keyboard
+from labtools.rng import RandomStreams
+from labtools.staircase import Quest
 
-from participant import SpatialCueingParticipant
-from trial_list import SpatialCueingTrialList
+from trial_list import SpatialCueingTrialList, COLUMN_TYPES
+from trial_bank import TrialBank
 
 
 class SpatialCueingExperiment(Experiment):
@@ -29,25 +32,67 @@ class SpatialCueingExperiment(Experiment):
         - auditory_word
 
     Cues are valid, invalid, or neutral.
+
+    Everything random in a session, e.g., the noise masks, the order of the
+    masks, the jitter of the target, and the choice of sound, is drawn from
+    its own stream of a labtools.rng.RandomStreams made from the seed, so a
+    session can be reproduced from the seed or from the state of the streams
+    saved with the data. Streams can also be given directly. If cue_types are
+    given, only the stimuli for those cues are loaded. To run without a
+    display, pass a backend with replacements for psychopy's modules, e.g., a
+    labtools.simulation.Simulation.
     """
-    def __init__(self, experiment_yaml):
-        self.window = visual.Window(fullscr=True, units='pix', allowGUI=False)
+    def __init__(self, experiment_yaml, seed=None, cue_types=None,
+                 backend=None, streams=None):
+        self.streams = streams or RandomStreams(seed)
+
+        if cue_types is None:
+            cue_types = ['visual_arrow', 'visual_word', 'auditory_word']
+
+        if backend is not None:
+            self.visual = backend.visual
+            self.core = backend.core
+            self.event = backend.event
+            self.sound = backend.sound
+            self.logging = backend.logging
+
+        self.window = self.visual.Window(fullscr=True, units='pix',
+                                         allowGUI=False)
 
         # Save any info in the yaml file to the experiment object
         with open(experiment_yaml, 'r') as f:
-            self.config = yaml.load(f)
+            self.config = yaml.safe_load(f)
         self.texts = self.config.pop('texts')
         self.times_in_seconds = self.config.pop('times_in_seconds')
         self.response_map = self.config.pop('response_map')
+        mask_options = self.config.pop('masks')
+        opacity_options = self.config.pop('target_opacity')
 
         # Create the fixation and prompt
         text_kwargs = {'height': 40, 'font': 'Consolas', 'color': 'black'}
-        self.fix = visual.TextStim(self.window, text='+', **text_kwargs)
-        self.prompt = visual.TextStim(self.window, text='?', **text_kwargs)
+        self.fix = self.visual.TextStim(self.window, text='+', **text_kwargs)
+        self.prompt = self.visual.TextStim(self.window, text='?', **text_kwargs)
+
+        # Create the masks. Noise masks are generated from a seed drawn
+        # from their own stream, so they can be reproduced from the
+        # recorded entropy and are cached under that seed.
+        if mask_options['source'] == 'noise':
+            noise_seed = int(
+                self.streams.seed_sequence('mask_noise').generate_state(1)[0]
+            )
+            atlas = load_noise_atlas(
+                mask_options['n_frames'],
+                size=mask_options['size'],
+                slope=mask_options['slope'],
+                seed=noise_seed,
+                cache_dir=mask_options['cache_dir'],
+            )
+        else:
+            atlas = True  # use the mask images
 
-        # Create the masks
         mask_size = 200
-        mask_kwargs = {'win': self.window, 'size': [mask_size, mask_size]}
+        mask_kwargs = {'win': self.window, 'size': [mask_size, mask_size],
+                       'atlas': atlas}
         gutter = 440  # distance between L/R and U/D centroids
         self.location_map = {
             'left': (-gutter/2, 0),
@@ -55,8 +100,13 @@ class SpatialCueingExperiment(Experiment):
             'up': (0, gutter/2),
             'down': (0, -gutter/2)
         }
-        self.masks = [DynamicMask(pos=p, **mask_kwargs)
-                      for p in self.location_map.values()]
+        self.masks = []
+        for name, pos in sorted(self.location_map.items()):
+            mask_rng = self.streams.generator('mask', name)
+            self.masks.append(DynamicMask(pos=pos, rng=mask_rng,
+                                          **mask_kwargs))
+        self.mask_array = MaskArray(self.masks,
+                                    stim_class=self.visual.ElementArrayStim)
 
         # Stimuli directory
         STIM_DIR = unipath.Path('stimuli')
@@ -64,52 +114,90 @@ class SpatialCueingExperiment(Experiment):
 
         # Create the arrow cues
         self.arrows = {}
-        for direction in ['left', 'right', 'neutral']:
-            arrow_png = unipath.Path(STIM_DIR, 'arrow-%s.png' % direction)
-            assert arrow_png.exists(), "%s not found" % arrow_png
-            arrow_png = str(arrow_png)  # psychopy doesn't like unipath.Path's
-            self.arrows[direction] = visual.ImageStim(self.window, arrow_png)
+        if 'visual_arrow' in cue_types:
+            for direction in ['left', 'right', 'neutral']:
+                arrow_png = unipath.Path(STIM_DIR, 'arrow-%s.png' % direction)
+                assert arrow_png.exists(), "%s not found" % arrow_png
+                self.arrows[direction] = self.visual.ImageStim(
+                    self.window, stimuli.image(arrow_png)
+                )
 
         # Create the visual word cue using same kwargs as fixation and prompt
-        self.word = visual.TextStim(self.window, text='', **text_kwargs)
+        self.word = self.visual.TextStim(self.window, text='', **text_kwargs)
 
         # Load the sound cues
         # There are multiple versions of each sound, so pick one like this:
-        # >>> random.choice(self.sounds['left']).play()
+        # >>> self.sound_random.choice(self.sounds['left']).play()
+        self.sound_random = self.streams.python_random('auditory_cue')
         self.sounds = {}
-        for direction in ['left', 'right', 'neutral']:
-            sounds_re = '%s-*.wav' % direction
-            self.sounds[direction] = load_sounds(STIM_DIR, sounds_re)
+        if 'auditory_word' in cue_types:
+            for direction in ['left', 'right', 'neutral']:
+                sounds_re = '%s-*.wav' % direction
+                self.sounds[direction] = load_sounds(
+                    STIM_DIR, sounds_re, registry=stimuli,
+                    loader=self.sound.Sound,
+                )
 
         # Create the target
         target_size = 80
-        self.target = visual.Rect(self.window, size=[target_size, target_size],
-                                  opacity=0.8, fillColor='white')
+        self.target_opacity = opacity_options.pop('opacity')
+        self.target = self.visual.Rect(self.window,
+                                       size=[target_size, target_size],
+                                       opacity=self.target_opacity,
+                                       fillColor='white')
+
+        # Estimate the opacity threshold as the session goes
+        self.quest = None
+        if opacity_options.pop('adaptive'):
+            self.quest = Quest(**opacity_options)
 
         # Create the stimuli for feedback
         incorrect_wav = unipath.Path(STIM_DIR, 'feedback-incorrect.wav')
         correct_wav = unipath.Path(STIM_DIR, 'feedback-correct.wav')
         self.feedback = {}
-        self.feedback[0] = sound.Sound(incorrect_wav)
-        self.feedback[1] = sound.Sound(correct_wav)
+        self.feedback[0] = stimuli.get(incorrect_wav, self.sound.Sound)
+        self.feedback[1] = stimuli.get(correct_wav, self.sound.Sound)
+
+        # Free any stimuli loaded for a previous session that aren't
+        # needed for this one
+        stimuli.sweep()
 
         # Create a closure function to jitter target positions with the
         # bounds of the mask
         no_edge_to_edge_buffer = target_size/6
         amount = mask_size - target_size - no_edge_to_edge_buffer
+        jitter_rng = self.streams.generator('jitter')
 
         def jitter(pos):
             """ For jittering the target. """
-            return (p + random.uniform(-amount/2, amount/2) for p in pos)
+            return (p + jitter_rng.uniform(-amount/2, amount/2) for p in pos)
         self.jitter = jitter
 
-        # Attach timer to experiment
-        self.timer = core.Clock()
+        # Convert the phases of a trial to frames using the refresh rate
+        # of this window
+        self.fps = measure_fps(self.window, default=self.config['fps'])
+        times = self.times_in_seconds
+        interval = times['cue_onset_to_target_onset'] - times['cue_duration']
+        self.frame_plan = FramePlan([
+            ('fixation', to_n_frames(times['fixation_duration'], self.fps)),
+            ('pre_cue', to_n_frames(times['fixation_offset_to_cue_onset'],
+                                    self.fps)),
+            ('cue', to_n_frames(times['cue_duration'], self.fps)),
+            ('interval', to_n_frames(interval, self.fps)),
+            ('target', to_n_frames(times['target_duration'], self.fps)),
+            ('clear', 1),  # clear the target before showing the prompt
+        ])
+        self.flips = FlipRecorder(self.frame_plan, self.fps)
+
+        # Collect responses with the time each key was pressed
+        self.keyboard = Keyboard(self.response_map.keys(), event=self.event,
+                                 clock=self.logging.defaultClock)
 
     def run_trial(self, trial):
-        """ Prepare the trial, run it, and return the trial data.
+        """ Prepare the trial, run it, and record the trial data.
 
-        trial is a namedtuple with attributes for each item in the trials list.
+        trial is a row of the trial list. Variables determined at runtime
+        are set on the trial, which stores them in the trial list.
         """
         # Set mask type
         for mask in self.masks:
@@ -130,7 +218,7 @@ class SpatialCueingExperiment(Experiment):
                 visual_cue.setText(trial.cue_dir)
         elif trial.cue_type == 'auditory_word':
             sound_options = self.sounds[trial.cue_dir].values()
-            auditory_cue = random.choice(sound_options)
+            auditory_cue = self.sound_random.choice(sound_options)
         else:
             msg = 'cue type %s not implemented' % trial.cue_type
             raise NotImplementedError(msg)
@@ -140,92 +228,75 @@ class SpatialCueingExperiment(Experiment):
         x, y = self.jitter(target_pos)
         self.target.setPos((x, y))
 
-        fps = 120 # frames per second of testing computers
-        def to_n_frames(time_in_seconds):
-            return int(fps * time_in_seconds)
-
-        # Fixation frames
-        n_fixation_frames = to_n_frames(
-            self.times_in_seconds['fixation_duration']
-        )
-        n_cue_frames = to_n_frames(
-            self.times_in_seconds['cue_duration']
-        )
-        # Fixation offset to cue onset frames
-        n_pre_cue_frames = to_n_frames(
-            self.times_in_seconds['fixation_offset_to_cue_onset']
-        )
-        # Cue offset to target onset frames
-        interval = self.times_in_seconds['cue_onset_to_target_onset'] - \
-            self.times_in_seconds['cue_duration']
-        n_interval_frames = to_n_frames(interval)
+        # Set the opacity of the target
+        if self.quest is not None:
+            self.target_opacity = self.quest.next_opacity()
+        self.target.setOpacity(self.target_opacity)
+
+        # Compile the frames for this trial
+        masks = self.mask_array
+        cue_draw_list = [masks]
+        if visual_cue:
+            cue_draw_list.append(visual_cue)
+        schedule = self.frame_plan.compile({
+            'fixation': [masks, self.fix],
+            'pre_cue': [masks],
+            'cue': cue_draw_list,
+            'interval': [masks, self.fix],
+            'target': [masks, self.target, self.fix],
+            'clear': [masks, self.fix],
+        })
+        cue_onset_frame = self.frame_plan.onsets['cue']
+
+        flip_times = self.flips.times
+        self.flips.reset()
+
+        # Keep any presses made from here on, including during the frames
+        self.keyboard.clear()
 
-        n_target_frames = to_n_frames(self.times_in_seconds['target_duration'])
-
-        self.timer.reset()
         # ----------------------------------------------------------------------
         # Start of trial presentation
 
-        # Fixation
-        for _ in range(n_fixation_frames):
-            self.draw_masks()
-            self.fix.draw()
-            self.window.flip()
-
-        # Fixation offset to cue onset
-        for _ in range(n_pre_cue_frames):
-            self.draw_masks()
-            self.window.flip()
-
-        # Start the auditory cue before entering cue loop
-        if auditory_cue:
-            auditory_cue.play()
-
-        # Draw the masks and visual cue, if present
-        for _ in range(n_cue_frames):
-            self.draw_masks()
-            if visual_cue:
-                visual_cue.draw()
-            self.window.flip()
-
-        # Draw the masks between the cue and target
-        for _ in range(n_interval_frames):
-            self.draw_masks()
-            self.fix.draw()
-            self.window.flip()
-
-        # Draw the target on top of the masks
-        target_onset = self.timer.getTime()
-        for _ in range(n_target_frames):
-            self.draw_masks()
-            self.target.draw()
-            self.fix.draw()
-            self.window.flip()
+        for frame, (_, draw_list) in enumerate(schedule):
+            if frame == cue_onset_frame and auditory_cue:
+                auditory_cue.play()
 
-        # Clear the target from the masks before showing the prompt
-        self.draw_masks()
-        self.fix.draw()
-        self.window.flip()
+            for stim in draw_list:
+                stim.draw()
+            flip_times[frame] = self.window.flip()
 
-        # Draw the prompt and wait for a response
+        # Draw the prompt and wait for a response if there hasn't been one
         self.prompt.draw()
-        self.window.flip()
-        responses = event.waitKeys(
-            keyList=self.response_map.keys(),
-            maxWait=self.times_in_seconds['response_window']
-        )
-        rt = self.timer.getTime() - target_onset
-
-        # Figure out how they responded
-        try:
-            response = responses[0]
-        except TypeError:
-            response_type = 'timeout'
+        flip_times[-1] = self.window.flip()
+        presses = self.keyboard.get_presses()
+        if not presses:
+            presses = self.keyboard.wait_press(
+                max_wait=self.times_in_seconds['response_window']
+            )
+
+        # Figure out how they responded. RTs are measured from the flip
+        # that showed the target. Presses before the target, or too soon
+        # after it to be a response to it, are anticipatory.
+        target_onset = flip_times[self.frame_plan.onsets['target']]
+        if presses:
+            response, press_time = presses[0]
+            rt = press_time - target_onset
+            if rt < self.times_in_seconds['anticipation_cutoff']:
+                response_type = 'anticipatory'
+            else:
+                response_type = self.response_map[response]
         else:
-            response_type = self.response_map[response]
+            rt = flip_times[-1] + self.times_in_seconds['response_window'] - \
+                target_onset
+            response_type = 'timeout'
 
         is_correct = int(response_type == trial.target_loc)
 
+        # Update the estimate of the threshold. Anticipatory responses
+        # don't say whether the target was seen.
+        if self.quest is not None and response_type != 'anticipatory':
+            self.quest.update(self.target_opacity, is_correct)
+
         # Give auditory feedback
         self.feedback[is_correct].play()
 
@@ -236,29 +307,30 @@ class SpatialCueingExperiment(Experiment):
         # End of trial presentation
         # ----------------------------------------------------------------------
 
-        # Create a writable copy of the trial
-        trial_data = OrderedDict()
-        for key, value in zip(trial._fields, trial):
-            trial_data[key] = value
+        # Add variables determined at runtime to the trial
+        trial.soa = self.times_in_seconds['cue_onset_to_target_onset']
+        trial.target_loc_x = x
+        trial.target_loc_y = y
+        trial.target_opacity = self.target_opacity
+        if self.quest is not None:
+            trial.opacity_threshold = self.quest.mean()
+            trial.opacity_threshold_sd = self.quest.sd()
 
-        # Add variables determined at runtime to trial data
-        trial_data['soa'] = self.times_in_seconds['cue_onset_to_target_onset']
-        trial_data['target_loc_x'] = x
-        trial_data['target_loc_y'] = y
+        # Add the timing of the frames that were actually shown
+        trial._update(self.flips.summarize())
 
-        # Add response variables to trial data
-        trial_data['rt'] = rt * 1000
-        trial_data['response_type'] = response_type
-        trial_data['is_correct'] = is_correct
+        # Add response variables to the trial
+        trial.rt = rt * 1000
+        trial.response_type = response_type
+        trial.is_correct = is_correct
 
         # ITI
-        core.wait(self.times_in_seconds['inter_trial_interval'])
+        self.core.wait(self.times_in_seconds['inter_trial_interval'])
 
-        return trial_data
+        return trial
 
     def draw_masks(self):
-        for mask in self.masks:
-            mask.draw()
+        self.mask_array.draw()
 
     def show_instructions(self, mask_type):
         texts = self.texts['instructions']
@@ -269,7 +341,7 @@ class SpatialCueingExperiment(Experiment):
             mask.is_flicker = (mask_type == 'mask')
             mask.pick_new_mask()
 
-        title = visual.TextStim(
+        title = self.visual.TextStim(
             self.window, text='Welcome to the SPC Experiment', height=60,
             font='Consolas', color='black', pos=[0,200], wrapWidth=1000,
         )
@@ -277,16 +349,16 @@ class SpatialCueingExperiment(Experiment):
         text_kwargs = dict(wrapWidth=900, height=20, color='black',
                            font='Consolas')
 
-        instructions = visual.TextStim(self.window, **text_kwargs)
+        instructions = self.visual.TextStim(self.window, **text_kwargs)
 
         # Instructions 1
         title.draw()
         instructions.setText(texts[1])
         instructions.draw()
         self.window.flip()
-        response = event.waitKeys()[0]
+        response = self.event.waitKeys()[0]
         if response == 'q':
-            core.quit()
+            self.core.quit()
 
         # Instructions 2
         instructions.setText(texts[2])
@@ -298,17 +370,17 @@ class SpatialCueingExperiment(Experiment):
 
         footer_kwargs = dict(text_kwargs)
         footer_kwargs['wrapWidth'] = 220
-        footer = visual.TextStim(self.window, pos=[0,0], **footer_kwargs)
+        footer = self.visual.TextStim(self.window, pos=[0,0], **footer_kwargs)
         footer.setText('The target is present. Do you see it?')
 
         instructions.draw()
         self.window.flip()
-        event.waitKeys()
+        self.event.waitKeys()
 
         for _ in range(5):
             self.draw_masks()
             self.window.flip()
-            core.wait(0.5)
+            self.core.wait(0.5)
 
         for n in range(10):
             if n == 9:
@@ -318,35 +390,35 @@ class SpatialCueingExperiment(Experiment):
             self.draw_masks()
             self.target.draw()
             self.window.flip()
-            core.wait(0.5)
+            self.core.wait(0.5)
 
-        response = event.waitKeys()[0]
+        response = self.event.waitKeys()[0]
         if response == 'q':
-            core.quit()
+            self.core.quit()
 
         # Instructions 3
         instructions.setText(texts[3])
         instructions.draw()
         self.window.flip()
-        response = event.waitKeys()[0]
+        response = self.event.waitKeys()[0]
         if response == 'q':
-            core.quit()
+            self.core.quit()
 
         # Instructions 4
         instructions.setText(texts[4])
         instructions.draw()
         self.window.flip()
-        response = event.waitKeys()[0]
+        response = self.event.waitKeys()[0]
         if response == 'q':
-            core.quit()
+            self.core.quit()
 
         # Instructions 5
         instructions.setText(texts[5])
         instructions.draw()
         self.window.flip()
-        response = event.waitKeys()[0]
+        response = self.event.waitKeys()[0]
         if response == 'q':
-            core.quit()
+            self.core.quit()
 
     def show_end_of_practice_screen(self):
         self.show_text(self.texts['end_of_practice'])
@@ -357,35 +429,88 @@ class SpatialCueingExperiment(Experiment):
     def show_end_screen(self):
         self.show_text(self.texts['end_of_experiment'])
 
+
+def run_session(experiment, trial_list, data_file, flips_file,
+                arrow_file=None):
+    """ Run all trials, writing the data for each trial as it finishes.
+
+    If an arrow_file is given, e.g., a labtools.arrow_writer.ArrowWriter,
+    the data for each block is also written to it when the block ends.
+    """
+    data_file.write(trial_list.header())
+    experiment.flips.write_header(flips_file)
+
+    block = 0
+    block_start = 0
+    for ix, trial in enumerate(trial_list):
+        # Before starting new block, show the break screen
+        if trial.block > block:
+            if arrow_file is not None:
+                arrow_file.write_rows(trial_list, block_start, ix)
+            block_start = ix
+            if block == 0:
+                # Just finished the practice trials
+                experiment.show_end_of_practice_screen()
+            else:
+                experiment.show_break_screen()
+            block = trial.block
+        experiment.run_trial(trial)
+        trial_list.write(data_file, ix, ix + 1)
+        experiment.flips.write(flips_file, trial.trial)
+
+    if arrow_file is not None:
+        arrow_file.write_rows(trial_list, block_start, len(trial_list))
+
+
 if __name__ == '__main__':
+    from participant import SpatialCueingParticipant
+
     participant = SpatialCueingParticipant.from_yaml('participant.yaml')
     participant.get_subj_info()
 
     trial_list_kwargs = participant.get_trial_list_kwargs()
-    random.seed(trial_list_kwargs['seed'])
-    trial_list = SpatialCueingTrialList.from_kwargs(**trial_list_kwargs)
 
-    experiment = SpatialCueingExperiment('experiment.yaml')
+    # Draw the trials and everything in the experiment from one set of
+    # streams, so they are all recorded with the data
+    streams = RandomStreams(participant['seed'])
+
+    # Read the trials from the bank made by trial_bank.py if there is one
+    bank = TrialBank.open_if_exists('trials.bank')
+    trial_list = SpatialCueingTrialList.from_kwargs(bank=bank,
+                                                    streams=streams,
+                                                    **trial_list_kwargs)
+
+    experiment = SpatialCueingExperiment(
+        'experiment.yaml',
+        streams=streams,
+        cue_types=trial_list_kwargs['cue_type'],
+    )
     experiment.show_instructions(mask_type = participant['mask_type'])
 
-    with open(participant['data_filename'], 'w') as data_file:
-        data_file.write(trial_list.header())
-        data_file.flush()
-
-        block = 0
-        for trial in trial_list:
-            # Before starting new block, show the break screen
-            if trial.block > block:
-                if block == 0:
-                    # Just finished the practice trials
-                    experiment.show_end_of_practice_screen()
-                else:
-                    experiment.show_break_screen()
-                block = trial.block
-            trial_data = experiment.run_trial(trial)
-            trial_str = ','.join(map(str, trial_data.values())) + '\n'
-            data_file.write(trial_str)
-            data_file.flush()
+    data_filename = participant['data_filename']
+    flips_filename = unipath.Path(data_filename.parent,
+                                  data_filename.stem + '.flips')
+    arrow_filename = unipath.Path(data_filename.parent,
+                                  data_filename.stem + '.arrow')
+    rng_filename = unipath.Path(data_filename.parent,
+                                data_filename.stem + '.rng.json')
+
+    # Data files are written in the background so that trials never
+    # wait on the disk. The typed copy of the data is only written if
+    # pyarrow is installed. The random number streams are saved before
+    # the session starts and again when it ends, even if it crashes, so
+    # the session can be reproduced.
+    arrow_file = ArrowWriter.open_if_available(arrow_filename, COLUMN_TYPES)
+    streams.write(rng_filename)
+    try:
+        with AsyncWriter(data_filename) as data_file, \
+                AsyncWriter(flips_filename, mode='wb') as flips_file:
+            run_session(experiment, trial_list, data_file, flips_file,
+                        arrow_file)
+    finally:
+        if arrow_file is not None:
+            arrow_file.close()
+        streams.write(rng_filename)
 
     experiment.show_end_screen()
 
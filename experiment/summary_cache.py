@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+""" Keep a running summary of the data collected so far.
+
+For each subject, the cache holds sufficient statistics for every cell of
+cue_validity x cue_type x mask_type in the test blocks: the number of
+trials, the number correct, and the count, sum, and sum of squares of the
+RTs of correct responses, along with a histogram of those RTs in
+RT_BIN_MS bins, with the sum of the RTs in each bin so that means trimmed
+at bin edges are exact. Group-level cueing effects are computed from the
+cache without reading any data files.
+
+    python summary_cache.py --data-dir data --trim 200 2000
+
+Updating the cache only reads the data files that are new or have changed
+since the last update, and drops subjects whose files were removed.
+"""
+import argparse
+import glob
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas
+
+from trial_list import CUE_CONTRASTS, CUE_VALIDITIES
+from trial_bank import MASK_TYPES
+
+CUE_TYPES = sorted(set(sum(CUE_CONTRASTS.values(), [])))
+CELLS = (len(CUE_VALIDITIES), len(CUE_TYPES), len(MASK_TYPES))
+
+RT_BIN_MS = 10
+MAX_RT_MS = 3000  # RTs past the last bin are counted in an overflow bin
+N_BINS = MAX_RT_MS // RT_BIN_MS + 1
+
+# Arrays of statistics for each subject, with the shape of each one
+STATS = OrderedDict([
+    ('n_trials', CELLS),
+    ('n_correct', CELLS),
+    ('n_rt', CELLS),
+    ('rt_sum', CELLS),
+    ('rt_sumsq', CELLS),
+    ('rt_hist', CELLS + (N_BINS, )),
+    ('rt_hist_sum', CELLS + (N_BINS, )),
+])
+
+
+def _codes(values, levels):
+    """ Integer codes of values in levels, -1 for values not in levels. """
+    lookup = {level: code for code, level in enumerate(levels)}
+    return np.array([lookup.get(value, -1) for value in values], dtype=int)
+
+
+def summarize_trials(trials, source='trials'):
+    """ Compute the statistics of one subject from a DataFrame of trials.
+
+    Test trials with a cue_validity, cue_type, or mask_type that isn't a
+    cell of the summary are left out with a warning naming the source.
+
+    Returns a dict of arrays with the shapes in STATS.
+    """
+    trials = trials[trials.block > 0]
+    validity = _codes(trials.cue_validity, CUE_VALIDITIES)
+    cue_type = _codes(trials.cue_type, CUE_TYPES)
+    mask_type = _codes(trials.mask_type, MASK_TYPES)
+    in_cell = (validity >= 0) & (cue_type >= 0) & (mask_type >= 0)
+    if not in_cell.all():
+        outside = trials[~in_cell]
+        levels = sorted(set(zip(outside.cue_validity, outside.cue_type,
+                                outside.mask_type)), key=str)
+        warnings.warn('%s: %d test trials are not in a cell of the summary '
+                      '(cue_validity, cue_type, mask_type): %s' %
+                      (source, len(outside), levels))
+    cell = np.ravel_multi_index((validity[in_cell], cue_type[in_cell],
+                                 mask_type[in_cell]), CELLS)
+    n_cells = int(np.prod(CELLS))
+
+    is_correct = pandas.to_numeric(trials.is_correct, errors='coerce')
+    is_correct = is_correct.fillna(0).values[in_cell] > 0
+    rt = pandas.to_numeric(trials.rt, errors='coerce').values[in_cell]
+    has_rt = is_correct & ~np.isnan(rt)
+    rt_cell = cell[has_rt]
+    rt = rt[has_rt]
+    rt_bin = np.clip((rt // RT_BIN_MS).astype(int), 0, N_BINS - 1)
+    hist_ix = rt_cell * N_BINS + rt_bin
+
+    def count(ix, weights=None, size=n_cells):
+        return np.bincount(ix, weights, minlength=size).astype(float)
+
+    stats = {
+        'n_trials': count(cell),
+        'n_correct': count(cell[is_correct]),
+        'n_rt': count(rt_cell),
+        'rt_sum': count(rt_cell, rt),
+        'rt_sumsq': count(rt_cell, rt ** 2),
+        'rt_hist': count(hist_ix, size=n_cells * N_BINS),
+        'rt_hist_sum': count(hist_ix, rt, size=n_cells * N_BINS),
+    }
+    return {name: values.reshape(STATS[name])
+            for name, values in stats.items()}
+
+
+def summarize_file(data_file):
+    """ Compute the statistics of one subject from their data file. Empty
+    files have no trials. """
+    if os.path.getsize(data_file) == 0:
+        return {name: np.zeros(shape) for name, shape in STATS.items()}
+    trials = pandas.read_csv(data_file, usecols=['block', 'mask_type',
+                                                 'cue_type', 'cue_validity',
+                                                 'rt', 'is_correct'])
+    return summarize_trials(trials, data_file)
+
+
+class SummaryCache(object):
+    """ Statistics of every subject, stacked into arrays.
+
+    The cache is saved as an npz file with the arrays in STATS, the
+    subjects, and the size and mtime of each subject's data file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.subjects = []
+        self.sizes = np.zeros(0, dtype=int)
+        self.mtimes = np.zeros(0)
+        self.stats = {name: np.zeros((0, ) + shape)
+                      for name, shape in STATS.items()}
+        if os.path.exists(filename):
+            cache = np.load(filename)
+            if (N_BINS, RT_BIN_MS) == tuple(cache['bins']):
+                self.subjects = [str(subject) for subject in cache['subjects']]
+                self.sizes = cache['sizes']
+                self.mtimes = cache['mtimes']
+                self.stats = {name: cache[name] for name in STATS}
+
+    def update(self, data_dir, pattern='*.csv'):
+        """ Read new or changed data files and remove subjects whose files
+        are gone. Subjects are named by their data files.
+
+        Returns the subjects that were read.
+        """
+        data_files = {os.path.splitext(os.path.basename(path))[0]: path
+                      for path in glob.glob(os.path.join(data_dir, pattern))}
+        cached = {subject: ix for ix, subject in enumerate(self.subjects)}
+
+        subjects = sorted(data_files)
+        sizes = np.zeros(len(subjects), dtype=int)
+        mtimes = np.zeros(len(subjects))
+        stats = {name: np.zeros((len(subjects), ) + shape)
+                 for name, shape in STATS.items()}
+        read = []
+        for ix, subject in enumerate(subjects):
+            stat = os.stat(data_files[subject])
+            sizes[ix], mtimes[ix] = stat.st_size, stat.st_mtime
+            old_ix = cached.get(subject)
+            if (old_ix is not None and self.sizes[old_ix] == sizes[ix] and
+                    self.mtimes[old_ix] == mtimes[ix]):
+                for name in STATS:
+                    stats[name][ix] = self.stats[name][old_ix]
+            else:
+                summary = summarize_file(data_files[subject])
+                for name in STATS:
+                    stats[name][ix] = summary[name]
+                read.append(subject)
+
+        changed = read or len(subjects) != len(self.subjects)
+        self.subjects, self.sizes, self.mtimes = subjects, sizes, mtimes
+        self.stats = stats
+        if changed or not os.path.exists(self.filename):
+            self.save()
+        return read
+
+    def save(self):
+        with open(self.filename, 'wb') as f:
+            np.savez(f, subjects=np.array(self.subjects, dtype=str),
+                     sizes=self.sizes, mtimes=self.mtimes,
+                     bins=np.array([N_BINS, RT_BIN_MS]), **self.stats)
+
+    def _rt_sums(self, trim=None):
+        """ Count and sum of RTs in each cell, only counting RTs between
+        trim = (min_ms, max_ms), rounded to the nearest bin edges. """
+        if trim is None:
+            return self.stats['n_rt'], self.stats['rt_sum']
+        first, last = [int(round(ms / float(RT_BIN_MS))) for ms in trim]
+        bins = slice(max(first, 0), min(last, N_BINS - 1))
+        return (self.stats['rt_hist'][..., bins].sum(axis=-1),
+                self.stats['rt_hist_sum'][..., bins].sum(axis=-1))
+
+    def cell_means(self, trim=None):
+        """ Accuracy and mean RT of correct responses for every subject
+        and cell. The RT sd is only given without trimming. """
+        n_rt, rt_sum = self._rt_sums(trim)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns = OrderedDict([
+                ('n_trials', self.stats['n_trials']),
+                ('accuracy', self.stats['n_correct'] /
+                 self.stats['n_trials']),
+                ('n_rt', n_rt),
+                ('rt', rt_sum / n_rt),
+            ])
+            if trim is None:
+                variance = (self.stats['rt_sumsq'] - rt_sum ** 2 / n_rt) / \
+                    (n_rt - 1)
+                columns['rt_sd'] = np.sqrt(variance)
+
+        index = pandas.MultiIndex.from_product(
+            [self.subjects, CUE_VALIDITIES, CUE_TYPES, MASK_TYPES],
+            names=['subj_id', 'cue_validity', 'cue_type', 'mask_type'])
+        frame = pandas.DataFrame({name: values.ravel()
+                                  for name, values in columns.items()},
+                                 index=index, columns=list(columns))
+        return frame[frame.n_trials > 0]
+
+    def cueing_effect(self, trim=None):
+        """ The mean RT of invalid minus valid trials across subjects, for
+        each cue_type and mask_type. """
+        n_rt, rt_sum = self._rt_sums(trim)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rt = rt_sum / n_rt
+        effect = (rt[:, CUE_VALIDITIES.index('invalid')] -
+                  rt[:, CUE_VALIDITIES.index('valid')])
+
+        n_subjects = (~np.isnan(effect)).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(effect, axis=0) / n_subjects
+            deviations = np.where(np.isnan(effect), 0, effect - mean)
+            sd = np.sqrt((deviations ** 2).sum(axis=0) / (n_subjects - 1))
+            se = sd / np.sqrt(n_subjects)
+
+        index = pandas.MultiIndex.from_product([CUE_TYPES, MASK_TYPES],
+                                               names=['cue_type',
+                                                      'mask_type'])
+        frame = pandas.DataFrame({
+            'n_subjects': n_subjects.ravel(),
+            'cueing_effect': mean.ravel(),
+            'se': se.ravel(),
+        }, index=index, columns=['n_subjects', 'cueing_effect', 'se'])
+        return frame[frame.n_subjects > 0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cache', default='summary_cache.npz')
+    parser.add_argument('--trim', nargs=2, type=float,
+                        metavar=('MIN_MS', 'MAX_MS'),
+                        help='only count RTs between MIN_MS and MAX_MS')
+    args = parser.parse_args()
+
+    cache = SummaryCache(args.cache)
+    cache.update(args.data_dir)
+    print(cache.cueing_effect(args.trim).to_string())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+""" Precompute trial lists for a range of seeds and store them in one file.
+
+Making a trial list at the start of a session means importing pandas and
+drawing the trials, which takes a few seconds on the lab computers. A bank
+made ahead of time holds the trials for every combination of seed,
+cue_contrast, and mask_type, and the trials for a participant can be read
+from it almost immediately.
+
+    python trial_bank.py --first-seed 100 --n-seeds 1000 --output trials.bank
+
+The bank holds the integer codes made by the trial list generator, so the
+trials read from a bank are the same as the trials that would be generated
+for the participant. Seeds that aren't in the bank are generated as usual.
+The header records a version of the code that draws the trials, a hash of
+trial_list.py and labtools/rng.py, and a bank made by a different version
+isn't used. Rebuild the bank after changing how trial lists are made.
+
+File layout: the magic bytes, the length of a JSON header, the header, and
+then one contiguous block for each column of codes. The header has the
+categories for each code, the seed range, and the offset of each column.
+The rows for each (seed, cue_contrast, mask_type) are found from an array
+of row offsets, so a lookup only touches the rows it needs.
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import struct
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+import labtools.rng
+import trial_list
+from trial_list import (CUE_CONTRASTS, TARGET_LOCS, CUE_VALIDITIES, CUE_DIRS,
+                        draw_trials)
+
+MAGIC = b'TRIALBANK1'
+MASK_TYPES = ['mask', 'nomask']
+
+# Columns of codes stored in the bank and their dtypes
+CODE_COLUMNS = OrderedDict([
+    ('block', '<u1'),
+    ('mask_type', '<u1'),
+    ('cue_type', '<u1'),
+    ('cue_validity', '<u1'),
+    ('cue_dir', '<u1'),
+    ('target_loc', '<u1'),
+])
+
+_ALIGNMENT = 8
+
+
+def _align(n):
+    return -(-n // _ALIGNMENT) * _ALIGNMENT
+
+
+def generator_version():
+    """ Identify the code that draws the trials in a bank. """
+    key = hashlib.md5()
+    for module in [trial_list, labtools.rng]:
+        key.update(inspect.getsource(module).encode('utf-8'))
+    return key.hexdigest()[:12]
+
+
+class StaleBankError(ValueError):
+    """ The bank was made by a different version of the trial list code. """
+
+
+def build_bank(filename, seeds, cue_contrasts=None, mask_types=None):
+    """ Draw the trials for every seed and condition and write the bank.
+
+    :param str filename: Where to write the bank.
+    :param seeds: A contiguous range of seeds.
+    :param list cue_contrasts: Names in trial_list.CUE_CONTRASTS. Defaults
+        to all of them.
+    :param list mask_types: Defaults to MASK_TYPES.
+    """
+    seeds = list(seeds)
+    if seeds != list(range(seeds[0], seeds[0] + len(seeds))):
+        raise ValueError('seeds must be a contiguous range')
+    cue_contrasts = list(cue_contrasts or CUE_CONTRASTS)
+    mask_types = list(mask_types or MASK_TYPES)
+
+    columns = OrderedDict((name, []) for name in CODE_COLUMNS)
+    row_offsets = [0]
+    for seed in seeds:
+        for cue_contrast in cue_contrasts:
+            for mask_type in mask_types:
+                trials = draw_trials(seed, CUE_CONTRASTS[cue_contrast],
+                                     mask_type)
+                for name in CODE_COLUMNS:
+                    columns[name].append(trials[name])
+                row_offsets.append(row_offsets[-1] + len(trials['block']))
+
+    blocks = [('row_offsets', np.array(row_offsets, dtype='<i8'))]
+    for name, dtype in CODE_COLUMNS.items():
+        codes = np.concatenate(columns[name])
+        if codes.max() > np.iinfo(dtype).max:
+            raise ValueError('codes for %s do not fit in %s' % (name, dtype))
+        blocks.append((name, codes.astype(dtype)))
+
+    header = OrderedDict([
+        ('generator_version', generator_version()),
+        ('first_seed', seeds[0]),
+        ('n_seeds', len(seeds)),
+        ('cue_contrasts', OrderedDict((c, CUE_CONTRASTS[c])
+                                      for c in cue_contrasts)),
+        ('mask_types', mask_types),
+        ('target_locs', TARGET_LOCS),
+        ('cue_validities', CUE_VALIDITIES),
+        ('cue_dirs', CUE_DIRS),
+        ('n_rows', row_offsets[-1]),
+        ('columns', OrderedDict()),
+    ])
+
+    # Column offsets depend on the length of the header, which depends on
+    # the offsets, so leave room for the offsets before measuring it
+    for name, values in blocks:
+        header['columns'][name] = [values.dtype.str, 10 ** 12]
+    data_start = _align(len(MAGIC) + 4 + len(json.dumps(header)))
+
+    offset = data_start
+    for name, values in blocks:
+        header['columns'][name] = [values.dtype.str, offset]
+        offset = _align(offset + values.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(filename, 'wb') as bank_file:
+        bank_file.write(MAGIC)
+        bank_file.write(struct.pack('<I', len(header_bytes)))
+        bank_file.write(header_bytes)
+        for name, values in blocks:
+            bank_file.write(b'\0' * (header['columns'][name][1] -
+                                     bank_file.tell()))
+            bank_file.write(values.tobytes())
+
+
+class TrialBank(object):
+    """ Trial lists read from a bank file.
+
+    Columns are memory-mapped, so opening a bank doesn't read the trials,
+    and getting a participant's trials only reads their rows. Opening a
+    bank made by a different version of the trial list code raises a
+    StaleBankError.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as bank_file:
+            if bank_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a trial bank' % filename)
+            header_len, = struct.unpack('<I', bank_file.read(4))
+            header = json.loads(bank_file.read(header_len).decode('utf-8'),
+                                object_pairs_hook=OrderedDict)
+        if header.get('generator_version') != generator_version():
+            raise StaleBankError('%s was made by a different version of the '
+                                 'trial list code, rebuild it with '
+                                 'trial_bank.py' % filename)
+
+        self.filename = filename
+        self.first_seed = header['first_seed']
+        self.n_seeds = header['n_seeds']
+        self.cue_contrasts = header['cue_contrasts']
+        self.mask_types = header['mask_types']
+        self.categories = {
+            'target_loc': header['target_locs'],
+            'cue_validity': header['cue_validities'],
+            'cue_dir': header['cue_dirs'],
+        }
+
+        n_offsets = (self.n_seeds * len(self.cue_contrasts) *
+                     len(self.mask_types) + 1)
+        self.columns = {}
+        for name, (dtype, offset) in header['columns'].items():
+            shape = n_offsets if name == 'row_offsets' else header['n_rows']
+            self.columns[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                           offset=offset, shape=(shape, ))
+
+    @classmethod
+    def open_if_exists(cls, filename):
+        """ Open the bank, or return None if there isn't one. A stale bank
+        is ignored with a warning, so the trials are generated instead. """
+        try:
+            return cls(filename)
+        except (IOError, OSError):
+            return None
+        except StaleBankError as error:
+            warnings.warn(str(error))
+            return None
+
+    def _key(self, seed, cue_contrast, mask_type):
+        try:
+            seed_ix = int(seed) - self.first_seed
+            contrast_ix = list(self.cue_contrasts).index(cue_contrast)
+            mask_ix = self.mask_types.index(mask_type)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= seed_ix < self.n_seeds:
+            return None
+        return ((seed_ix * len(self.cue_contrasts) + contrast_ix) *
+                len(self.mask_types) + mask_ix)
+
+    def __contains__(self, key):
+        return self._key(*key) is not None
+
+    def get(self, seed, cue_contrast, mask_type):
+        """ Get the codes for a participant's trials.
+
+        :return: A dict of arrays of codes, like those made by
+            trial_list.draw_trials, or None if the trials aren't in the bank.
+        """
+        if isinstance(mask_type, (list, tuple)):
+            if len(mask_type) != 1:
+                return None
+            mask_type = mask_type[0]
+
+        key = self._key(seed, cue_contrast, mask_type)
+        if key is None:
+            return None
+
+        start, stop = self.columns['row_offsets'][key:key + 2]
+        return {name: np.array(self.columns[name][start:stop], dtype=int)
+                for name in CODE_COLUMNS}
+
+    def cue_type(self, cue_contrast):
+        """ The cue types that the cue_type codes refer to. """
+        return self.cue_contrasts[cue_contrast]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--first-seed', type=int, default=100)
+    parser.add_argument('--n-seeds', type=int, default=1000)
+    parser.add_argument('--cue-contrast', nargs='+',
+                        choices=list(CUE_CONTRASTS))
+    parser.add_argument('--mask-type', nargs='+', choices=MASK_TYPES)
+    parser.add_argument('--output', default='trials.bank')
+    args = parser.parse_args()
+
+    build_bank(args.output,
+               range(args.first_seed, args.first_seed + args.n_seeds),
+               cue_contrasts=args.cue_contrast,
+               mask_types=args.mask_type)
@@ -1,140 +1,329 @@
-import random
+from collections import OrderedDict
+from itertools import product
 
-import pandas
+import numpy as np
 
+from labtools.rng import RandomStreams
 from labtools.trial_list import TrialList
-from labtools.trials_functions import (counterbalance, expand, extend,
-                                       add_block, simple_shuffle)
 
+# Cue types compared in each version of the experiment
+CUE_CONTRASTS = OrderedDict([
+    ('word_arrow', ['visual_word', 'visual_arrow']),
+    ('visual_auditory', ['visual_word', 'auditory_word']),
+])
 
-def spatial_cueing_trial_list(cue_type, mask_type, **participant_kwargs):
-    trials = counterbalance({
-        'target_loc': ['left', 'right'],
-        'cue_type': cue_type,
-        'mask_type': mask_type,
-    })
+# Categories of the columns that vary within a participant. Trials are
+# generated as integer codes into these lists.
+TARGET_LOCS = ['left', 'right', 'up', 'down']
+CUE_VALIDITIES = ['valid', 'invalid', 'neutral']
+CUE_DIRS = ['left', 'right', 'neutral']
+
+# Number of unique trials per cell of target_loc x cue_type x mask_type:
+# 66.6% valid, 25% invalid, 8.3% neutral
+VALIDITY_COUNTS = [('valid', 8), ('invalid', 3), ('neutral', 1)]
+
+NUM_PRACTICE_TRIALS = 15
+MAX_TEST_TRIALS = 320  # ~ 20 trials in each within subject cell
+BLOCK_SIZE = 80
+
+PARTICIPANT_KEYS = [
+    'subj_id',
+    'seed',
+    'sona_experiment_code',
+    'experimenter',
+    'cue_contrast',
+]
+
+TRIAL_KEYS = [
+    'block',
+    'trial',
+    'mask_type',
+    'cue_type',
+    'cue_validity',
+    'cue_dir',
+    'target_loc',
+]
+
+# Columns filled at runtime
+RUNTIME_KEYS = [
+    'soa',
+    'target_loc_x',
+    'target_loc_y',
+    'target_opacity',
+    'opacity_threshold',
+    'opacity_threshold_sd',
+    'measured_soa',
+    'fixation_ms',
+    'pre_cue_ms',
+    'cue_ms',
+    'interval_ms',
+    'target_ms',
+    'clear_ms',
+    'dropped_frames',
+    'rt',
+    'response_type',
+    'is_correct',
+]
+
+# Types of the columns in the arrow files written alongside the csv
+COLUMN_TYPES = OrderedDict(
+    [(name, 'string') for name in PARTICIPANT_KEYS] +
+    [(name, 'category') for name in TRIAL_KEYS + RUNTIME_KEYS]
+)
+COLUMN_TYPES.update(
+    seed='int',
+    block='int',
+    trial='int',
+    soa='float',
+    target_loc_x='float',
+    target_loc_y='float',
+    target_opacity='float',
+    opacity_threshold='float',
+    opacity_threshold_sd='float',
+    measured_soa='float',
+    fixation_ms='float',
+    pre_cue_ms='float',
+    cue_ms='float',
+    interval_ms='float',
+    target_ms='float',
+    clear_ms='float',
+    dropped_frames='int',
+    rt='float',
+    is_correct='int',
+)
+
+
+def _as_list(values):
+    if isinstance(values, (list, tuple)):
+        return list(values)
+    return [values]
+
+
+def _unique_trials(cue_type, mask_type):
+    """ Counterbalance target_loc, cue_type, and mask_type, and repeat each
+    cell to get the desired ratio of cue validities.
+
+    Returns a dict of integer codes for each column.
+    """
+    n_cells = 2 * len(cue_type) * len(mask_type)
+    cells = np.array(list(product(range(2), range(len(cue_type)),
+                                  range(len(mask_type)))))
+
+    validity = np.repeat(
+        [CUE_VALIDITIES.index(v) for v, _ in VALIDITY_COUNTS],
+        [n * n_cells for _, n in VALIDITY_COUNTS],
+    )
+    n_repeats = len(validity) // n_cells
+    cells = np.tile(cells, (n_repeats, 1))
+
+    return {
+        'target_loc': cells[:, 0],
+        'cue_type': cells[:, 1],
+        'mask_type': cells[:, 2],
+        'cue_validity': validity,
+    }
+
+
+def _with_cue_dir(trials):
+    """ Determine cue dir from the target and the cue validity. """
+    target_loc = trials['target_loc']
+    validity = trials['cue_validity']
+    trials['cue_dir'] = np.select(
+        [validity == CUE_VALIDITIES.index('valid'),
+         validity == CUE_VALIDITIES.index('invalid')],
+        [target_loc, 1 - target_loc],
+        default=CUE_DIRS.index('neutral'),
+    )
+    return trials
+
+
+def _take(trials, ix):
+    return {name: codes[ix] for name, codes in trials.items()}
+
+
+def _move_to_up_down(target_loc, ix, rng):
+    """ Move the targets at ix to a random vertical location. """
+    target_loc[ix] = TARGET_LOCS.index('up') + rng.integers(2, size=len(ix))
+
+
+def _draw_trials(unique, rng):
+    """ Make the practice and test trials for one participant.
+
+    Returns a dict of integer codes for each column, in the order the
+    trials will be run.
+    """
+    n_unique = len(unique['target_loc'])
+    unique = _with_cue_dir(dict(unique))
+    is_invalid = unique['cue_validity'] == CUE_VALIDITIES.index('invalid')
+
+    # Ensure that there are some up/down targets in the practice trials,
+    # and select a subset of trials for practice
+    practice = dict(unique, target_loc=unique['target_loc'].copy())
+    _move_to_up_down(practice['target_loc'], np.flatnonzero(is_invalid), rng)
+    practice = _take(practice, rng.choice(n_unique, NUM_PRACTICE_TRIALS,
+                                          replace=False))
+    practice['block'] = np.zeros(NUM_PRACTICE_TRIALS, dtype=int)
+
+    # Duplicate unique trials evenly to reach max
+    n_repeats = max(MAX_TEST_TRIALS // n_unique, 1)
+    test = _take(unique, np.tile(np.arange(n_unique), n_repeats))
+    n_test = len(test['target_loc'])
+
+    # Set target location for catch trials: half of the invalid trials
+    invalid_ix = np.flatnonzero(np.tile(is_invalid, n_repeats))
+    catch_ix = rng.choice(invalid_ix, len(invalid_ix) // 2, replace=False)
+    _move_to_up_down(test['target_loc'], np.sort(catch_ix), rng)
 
-    seed = participant_kwargs.get('seed')
-    random.seed(seed)
+    # Assign blocks randomly, dealing each cue validity evenly over blocks
+    n_blocks = max(n_test // BLOCK_SIZE, 1)
+    dealing_order = np.lexsort((rng.random(n_test), test['cue_validity']))
+    test['block'] = np.empty(n_test, dtype=int)
+    test['block'][dealing_order] = np.arange(n_test) % n_blocks + 1
 
-    # Determine cue validity, starting with the smallest group
-    # 66.6% valid, 25% invalid, 8.3% neutral
-    trials = expand(trials, 'cue_validity', values=['invalid', 'neutral'],
-                    ratio=0.75, seed=seed)
+    # Join the practice trials and shuffle within each block
+    trials = {name: np.concatenate([practice[name], test[name]])
+              for name in test}
+    order = np.lexsort((rng.random(len(trials['block'])), trials['block']))
+    return _take(trials, order)
 
-    trials = expand(trials, 'tmp_cue_valid', values=[1,0], ratio=0.7, seed=seed)
-    trials.loc[trials.tmp_cue_valid == 1, 'cue_validity'] = 'valid'
-    del trials['tmp_cue_valid']
+
+def _trial_columns(trials, cue_type, mask_type, participant_kwargs):
+    """ Convert the codes for a participant's trials to named columns.
+
+    Returns an OrderedDict of arrays for the participant and trial columns.
+    """
+    n_trials = len(trials['block'])
+    columns = OrderedDict()
 
     # Take anything given by the participant and put it in the trial list
-    for col_name, subj_info in participant_kwargs.items():
-        trials[col_name] = subj_info
-
-    # Target was determined, now determine cue dir based on cue validity
-    direction_reverser = {'left': 'right', 'right': 'left'}
-    def determine_cue_dir(trial):
-        target_loc = trial['target_loc']
-        if trial['cue_validity'] in 'valid':
-            return target_loc
-        elif trial['cue_validity'] == 'invalid':
-            return direction_reverser[target_loc]
-        elif trial['cue_validity'] == 'neutral':
-            return 'neutral'
+    for name in PARTICIPANT_KEYS:
+        value = participant_kwargs.get(name, '')
+        columns[name] = np.array([value] * n_trials, dtype=object)
+
+    categories = {
+        'target_loc': TARGET_LOCS,
+        'cue_validity': CUE_VALIDITIES,
+        'cue_dir': CUE_DIRS,
+        'cue_type': cue_type,
+        'mask_type': mask_type,
+    }
+    for name in TRIAL_KEYS:
+        if name == 'trial':
+            columns[name] = np.arange(n_trials)
+        elif name in categories:
+            levels = np.array(categories[name], dtype=object)
+            columns[name] = levels[trials[name]]
         else:
-            msg = 'cue validity %s not implemented' % trial['cue_validity']
-            raise NotImplementedError(msg)
-    trials['cue_dir'] = trials.apply(determine_cue_dir, axis=1)
-
-    # Save a copy of the practice trials
-    practice_trials = trials.copy()
-    practice_trials['block'] = 0
-
-    # Ensure that there are some up/down targets in the practice trials
-    practice_trial_invalid_ix = practice_trials.ix[
-        practice_trials.cue_validity == 'invalid',
-    ].index
-    practice_trial_target_loc = [random.choice(['up', 'down'])
-                                 for _ in practice_trial_invalid_ix]
-    practice_trials.ix[practice_trial_invalid_ix, 'target_loc'] = \
-        practice_trial_target_loc
-
-    # Select a subset of trials for practice
-    num_practice_trials = 15
-    sampled_trials = random.sample(practice_trials.index, num_practice_trials)
-    practice_trials = practice_trials.ix[sampled_trials]
-    practice_trials.reset_index(drop=True)
+            columns[name] = np.asarray(trials[name])
 
-    # Duplicate unique trials evenly to reach max
-    # 320 trials ~ 20 trials in each within subject cell
-    trials = extend(trials, max_length=320)
-
-    # Set target location for catch trials
-    invalid_trial_ix = trials.ix[trials.cue_validity == 'invalid',].index
-    catch_trial_ix = random.sample(invalid_trial_ix, len(invalid_trial_ix)/2)
-    catch_trial_target_loc = [random.choice(['up', 'down'])
-                              for _ in catch_trial_ix]
-    trials.ix[catch_trial_ix, 'target_loc'] = catch_trial_target_loc
-
-    # Assign block randomly
-    block_size = 80
-    trials = add_block(trials, size=block_size, id_col='cue_validity',
-                       start_at=1, seed=seed)
-
-    # Join the practice trials
-    trials = pandas.concat([practice_trials, trials])
-
-    # Shuffle by block
-    trials = simple_shuffle(trials, block='block', seed=seed)
-    trials = trials.reset_index(drop=True)
-
-    # Label trial number
-    trials.insert(0, 'trial', range(len(trials)))
-
-    # Rearrange columns
-    participant_keys = [
-        'subj_id',
-        'seed',
-        'sona_experiment_code',
-        'experimenter',
-        'cue_contrast',
-    ]
-    for p in participant_keys:
-        if p not in trials.columns:
-            trials[p] = ''
-
-    col_order = participant_keys + [
-        'block',
-        'trial',
-        'mask_type',
-        'cue_type',
-        'cue_validity',
-        'cue_dir',
-        'target_loc',
-    ]
-    assert all([c in trials.columns for c in col_order])
-    trials = trials[col_order]
-
-    # Fill columns decided at runtime
-    trials['soa'] = ''
-    trials['target_loc_x'] = ''
-    trials['target_loc_y'] = ''
-
-    # Fill response columns
-    trials['rt'] = ''
-    trials['response_type'] = ''
-    trials['is_correct'] = ''
+    return columns
 
-    return trials
+
+def _trial_list_rng(seed, streams=None):
+    streams = streams or RandomStreams(seed)
+    return streams.generator('trial_list')
+
+
+def draw_trials(seed, cue_type, mask_type):
+    """ Get the codes for the trials for a single seed. """
+    unique = _unique_trials(_as_list(cue_type), _as_list(mask_type))
+    return _draw_trials(unique, _trial_list_rng(seed))
+
+
+def spatial_cueing_trial_lists(participants):
+    """ Make the trial lists for many participants at once.
+
+    Each participant's trials are drawn from the trial_list stream of
+    their seed (see labtools.rng), so a participant gets the same trials
+    whether their list is made on its own or in a batch. A participant can
+    also give their own labtools.rng.RandomStreams as `streams`, e.g., the
+    streams of the experiment, so the trial_list stream is recorded with
+    the others.
+
+    :param list participants: Dicts of keyword arguments for
+        :func:`spatial_cueing_trial_list`, each with `cue_type`, `mask_type`
+        and participant info such as `subj_id` and `seed`.
+    :return: The trial lists of all participants, one after another.
+    :rtype: pandas.DataFrame
+    """
+    import pandas
+
+    unique_trials = {}
+    columns = {name: [] for name in PARTICIPANT_KEYS + TRIAL_KEYS}
+
+    for kwargs in participants:
+        cue_type = _as_list(kwargs['cue_type'])
+        mask_type = _as_list(kwargs['mask_type'])
+
+        design = (tuple(cue_type), tuple(mask_type))
+        if design not in unique_trials:
+            unique_trials[design] = _unique_trials(cue_type, mask_type)
+
+        rng = _trial_list_rng(kwargs.get('seed'), kwargs.get('streams'))
+        trials = _draw_trials(unique_trials[design], rng)
+
+        participant_columns = _trial_columns(trials, cue_type, mask_type,
+                                             kwargs)
+        for name, values in participant_columns.items():
+            columns[name].append(values)
+
+    frame = pandas.DataFrame({name: np.concatenate(values)
+                              for name, values in columns.items()})
+    frame = frame[PARTICIPANT_KEYS + TRIAL_KEYS]
+
+    for name in RUNTIME_KEYS:
+        frame[name] = ''
+
+    return frame
+
+
+def spatial_cueing_trial_list(cue_type, mask_type, **participant_kwargs):
+    participant_kwargs.update(cue_type=cue_type, mask_type=mask_type)
+    return spatial_cueing_trial_lists([participant_kwargs])
+
+
+# dtypes of the runtime columns that hold numbers
+RUNTIME_DTYPES = {'float': float, 'int': int}
 
 
 class SpatialCueingTrialList(TrialList):
     @classmethod
-    def from_kwargs(cls, **kwargs):
-        trials_frame = spatial_cueing_trial_list(**kwargs)
-        return cls.from_dataframe(trials_frame)
+    def from_kwargs(cls, bank=None, streams=None, **kwargs):
+        """ Make the trial list for a participant.
+
+        If a trial_bank.TrialBank is given and it has the participant's
+        trials, they are read from the bank instead of generated. If
+        labtools.rng.RandomStreams are given, the trials are drawn from
+        their trial_list stream instead of a new one made from the seed.
+        Trials in the bank were drawn from the start of the stream, so
+        the stream is recorded but not drawn from.
+        """
+        seed = kwargs.get('seed')
+        cue_contrast = kwargs.get('cue_contrast')
+        from_seed = streams is None or (streams.entropy == seed and
+                                        not streams.prefix)
+        if (bank is not None and cue_contrast in bank.cue_contrasts and
+                from_seed):
+            trials = bank.get(seed, cue_contrast, kwargs['mask_type'])
+            if trials is not None:
+                if streams is not None:
+                    streams.record('trial_list')
+                columns = _trial_columns(trials, bank.cue_type(cue_contrast),
+                                         _as_list(kwargs['mask_type']), kwargs)
+                for name in RUNTIME_KEYS:
+                    columns[name] = [''] * len(trials['block'])
+                return cls.from_columns(columns)._with_runtime_dtypes()
+
+        trials_frame = spatial_cueing_trial_list(streams=streams, **kwargs)
+        return cls.from_dataframe(trials_frame)._with_runtime_dtypes()
 
-    def header(self):
-        return ','.join(self[0]._fields) + '\n'
+    def _with_runtime_dtypes(self):
+        """ Make the numeric runtime columns empty arrays of their type. """
+        for name in RUNTIME_KEYS:
+            dtype = RUNTIME_DTYPES.get(COLUMN_TYPES[name])
+            if dtype is not None:
+                self.set_empty(name, dtype)
+        return self
 
 
 if __name__ == '__main__':
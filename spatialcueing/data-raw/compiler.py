@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+""" Compile the data from all versions of the spatial cueing experiment.
+
+A python version of compiler.R that only reparses the subject files that
+changed since the last run.
+
+    python compiler.py --output compiled
+
+Subject files are parsed and recoded in a pool of processes, and each
+subject's recoded trials are cached as a feather file. A manifest records
+the size, mtime, and md5 of every file in the cache. On the next run, files
+with the same size and mtime are taken from the cache, files with a new
+mtime are hashed to see whether they really changed, and only new or
+changed files are parsed. The subjects of each experiment are then combined
+into <output>/<experiment>.feather, and all of the experiments into
+<output>/spatial_cueing.feather, with the same columns as the
+spatial_cueing data in the R package. Experiments without any new, changed,
+or removed files aren't rebuilt. Changing this file or readers.py starts a
+new cache.
+
+Empty subject files, e.g., from sessions that were aborted, are skipped.
+Files that can't be compiled are left out, reported at the end, and tried
+again on the next run.
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import re
+import traceback
+import warnings
+from collections import namedtuple
+
+import numpy as np
+import pandas
+
+import readers
+
+DATA_RAW = os.path.dirname(os.path.abspath(__file__))
+
+# Subject files for each version of each experiment: the experiment, the
+# directory, a regex for the names of the files, and values that are the
+# same for every trial. unlabeled is the name of a last column that is
+# missing from the header (see readers.sniff).
+#
+# In the go/no-go experiment, the interval, which readers rename to soa,
+# was not the time between stimulus onsets, but it's kept as the soa for
+# now (see compiler.R).
+Source = namedtuple('Source', 'experiment directory pattern constants '
+                              'unlabeled')
+SOURCES = [
+    Source('go_nogo', 'go-nogo', 'SPC3?_3',
+           {'soa': 0.75, 'flicker': 'on'}, None),
+    Source('go_nogo', 'go-nogo', 'SPC4',
+           {'soa': 0.75, 'flicker': 'off'}, None),
+    Source('go_nogo', 'go-nogo', 'SPC5',
+           {'soa': 0.1, 'flicker': 'on'}, None),
+    Source('go_nogo', 'go-nogo', 'SPC6',
+           {'flicker': 'off'}, 'interval'),
+    Source('twomask', 'twomask', 'SPC', {'soa': 0.75}, None),
+    Source('fourmask_longsoa', 'fourmask-longsoa', 'P', {'soa': 0.75}, None),
+    Source('fourmask_shortsoa', 'fourmask-shortsoa', 'SPC', {}, None),
+]
+EXPERIMENTS = ['go_nogo', 'twomask', 'fourmask_longsoa', 'fourmask_shortsoa']
+
+# Go/no-go subjects run with the short interval by mistake
+SHORT_INTERVAL_SUBJECTS = ['SPC504a', 'SPC508']
+
+COLUMNS = [
+    # between-subject conditions
+    'experiment',
+    'cue_contrast',
+    'mask_type',
+
+    # lab identifiers
+    'subj_id',
+
+    # trial identifiers
+    'block',
+    'trial',
+
+    # cue vars
+    'cue_type',
+    'cue_dir',
+    'cue_validity',
+
+    # interval vars
+    'soa',
+
+    # target vars
+    'target_loc',
+    'target_loc_x',
+    'target_loc_y',
+
+    # response vars
+    'response_type',
+    'rt',
+    'is_correct',
+]
+CATEGORICAL = ['experiment', 'cue_contrast', 'mask_type', 'cue_type',
+               'cue_dir', 'cue_validity', 'target_loc', 'response_type']
+
+MANIFEST = 'manifest.json'
+
+
+def compiler_key():
+    """ Identify the code that parses and recodes the subject files. """
+    key = hashlib.md5()
+    for module in [compile_data, readers.read_file]:
+        source = inspect.getsource(inspect.getmodule(module))
+        key.update(source.encode('utf-8'))
+    return key.hexdigest()[:12]
+
+
+def find_files(sources=None):
+    """ Map the path of each subject file, relative to data-raw, to its
+    Source. Files are matched like list.files(pattern=...) in R. """
+    files = {}
+    for source in sources or SOURCES:
+        directory = os.path.join(DATA_RAW, source.directory)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if re.search(source.pattern, name) and os.path.isfile(path):
+                files[source.directory + '/' + name] = source
+    return files
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _recode_go_nogo(frame):
+    frame.loc[frame.subj_id.isin(SHORT_INTERVAL_SUBJECTS), 'soa'] = 0.1
+    frame['cue_type'] = frame.cue_type.replace('', 'nocue')
+    frame['response_b'] = frame.response_type.map({'go': 1, 'nogo': 0})
+    frame['target_loc'] = frame.target_loc.replace('', 'notarget')
+    frame['cue_validity'] = 'valid'
+    frame = frame[frame.part != 'practice'].copy()
+
+    frame['mask_type'] = np.where(frame.flicker == 'on', 'mask', 'nomask')
+    frame['cue_contrast'] = 'auditory_peripheral'
+    frame['block'] = 1
+    return frame
+
+
+def recode(frame, source):
+    """ Put the trials of one subject into the columns of the combined
+    data. Go/no-go files also keep response_b, 1 for go and 0 for nogo. """
+    for name, value in source.constants.items():
+        frame[name] = value
+    if source.experiment == 'go_nogo':
+        frame = _recode_go_nogo(frame)
+
+    frame['experiment'] = source.experiment
+    for name in ['target_loc_x', 'target_loc_y']:
+        if name not in frame:
+            frame[name] = np.nan
+
+    columns = list(COLUMNS)
+    if source.experiment == 'go_nogo':
+        columns.append('response_b')
+    return frame[columns].reset_index(drop=True)
+
+
+def _cache_path(cache_dir, relpath):
+    return os.path.join(cache_dir, relpath + '.feather')
+
+
+def _compile_file(args):
+    """ Parse, recode, and cache one subject file. Runs in the worker
+    processes.
+
+    Returns the relpath, whether the file was empty, and the traceback of
+    any error, so one bad file doesn't stop the others.
+    """
+    relpath, source, cache_dir = args
+    path = os.path.join(DATA_RAW, relpath)
+    cache_path = _cache_path(cache_dir, relpath)
+    try:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        frame = readers.read_file(path, source.unlabeled)
+        if frame.empty:
+            return relpath, True, None
+        frame = recode(frame, source)
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        frame.to_feather(cache_path)
+    except Exception:
+        return relpath, False, traceback.format_exc()
+    return relpath, False, None
+
+
+class Manifest(object):
+    """ The size, mtime, md5, and experiment of every subject file in
+    the cache. """
+    def __init__(self, cache_dir, key):
+        self.filename = os.path.join(cache_dir, MANIFEST)
+        self.key = key
+        self.files = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                manifest = json.load(f)
+            if manifest['key'] == key:
+                self.files = manifest['files']
+
+    def is_empty(self, relpath):
+        return self.files.get(relpath, {}).get('empty', False)
+
+    def is_current(self, relpath, stat):
+        """ Is the cache for the file current? Files whose mtime changed
+        are hashed, and if their contents are the same, their new mtime is
+        recorded. """
+        entry = self.files.get(relpath)
+        if entry is None or entry['size'] != stat.st_size:
+            return False
+        if entry['mtime'] == stat.st_mtime:
+            return True
+        if entry['md5'] == _md5(os.path.join(DATA_RAW, relpath)):
+            entry['mtime'] = stat.st_mtime
+            return True
+        return False
+
+    def update(self, relpath, stat, experiment, empty=False):
+        self.files[relpath] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'md5': _md5(os.path.join(DATA_RAW, relpath)),
+            'experiment': experiment,
+            'empty': empty,
+        }
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'key': self.key, 'files': self.files}, f, indent=2,
+                      sort_keys=True)
+
+
+def _as_categorical(frame):
+    for name in CATEGORICAL:
+        frame[name] = frame[name].astype('category')
+    return frame
+
+
+def compile_data(output_dir, processes=None, force=False):
+    """ Update the compiled data in output_dir.
+
+    Returns the names of the experiments that were rebuilt. Empty files
+    are skipped with a warning, and files that fail to compile are left
+    out of the compiled data and listed in a warning at the end.
+    """
+    cache_dir = os.path.join(output_dir, 'cache')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest = Manifest(cache_dir, compiler_key())
+    if force:
+        manifest.files = {}
+
+    files = find_files()
+    stats = {relpath: os.stat(os.path.join(DATA_RAW, relpath))
+             for relpath in files}
+    to_compile = [relpath for relpath in sorted(files)
+                  if not (manifest.is_current(relpath, stats[relpath]) and
+                          (manifest.is_empty(relpath) or
+                           os.path.exists(_cache_path(cache_dir, relpath))))]
+    removed = [relpath for relpath in manifest.files if relpath not in files]
+
+    changed = set(files[relpath].experiment for relpath in to_compile)
+    for relpath in removed:
+        changed.add(manifest.files.pop(relpath)['experiment'])
+        if os.path.exists(_cache_path(cache_dir, relpath)):
+            os.remove(_cache_path(cache_dir, relpath))
+
+    failed = {}
+    if to_compile:
+        tasks = [(relpath, files[relpath], cache_dir)
+                 for relpath in to_compile]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for relpath, empty, error in pool.imap_unordered(_compile_file,
+                                                             tasks):
+                if error is not None:
+                    failed[relpath] = error
+                    manifest.files.pop(relpath, None)
+                    continue
+                if empty:
+                    warnings.warn('skipping empty subject file %s' % relpath)
+                manifest.update(relpath, stats[relpath],
+                                files[relpath].experiment, empty)
+        finally:
+            pool.close()
+            pool.join()
+            manifest.save()
+
+    experiments = {}
+    for experiment in EXPERIMENTS:
+        filename = os.path.join(output_dir, experiment + '.feather')
+        if experiment not in changed and os.path.exists(filename):
+            continue
+        cache_paths = [_cache_path(cache_dir, relpath)
+                       for relpath, source in sorted(files.items())
+                       if source.experiment == experiment]
+        frame = pandas.concat([pandas.read_feather(path)
+                               for path in cache_paths
+                               if os.path.exists(path)], ignore_index=True)
+        experiments[experiment] = frame
+        _as_categorical(frame.copy()).to_feather(filename)
+
+    filename = os.path.join(output_dir, 'spatial_cueing.feather')
+    if experiments or not os.path.exists(filename):
+        frames = []
+        for experiment in EXPERIMENTS:
+            frame = experiments.get(experiment)
+            if frame is None:
+                frame = pandas.read_feather(
+                    os.path.join(output_dir, experiment + '.feather'))
+            frames.append(frame[COLUMNS].astype(
+                {name: object for name in CATEGORICAL}))
+        spatial_cueing = pandas.concat(frames, ignore_index=True)
+        _as_categorical(spatial_cueing).to_feather(filename)
+
+    if failed:
+        errors = ['%s: %s' % (relpath, error.strip().splitlines()[-1])
+                  for relpath, error in sorted(failed.items())]
+        warnings.warn('could not compile %d files:\n%s' %
+                      (len(failed), '\n'.join(errors)))
+    return sorted(experiments)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default=os.path.join(DATA_RAW, 'compiled'))
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help='reparse every file')
+    args = parser.parse_args()
+
+    rebuilt = compile_data(args.output, args.processes, args.force)
+    print('rebuilt: %s' % (', '.join(rebuilt) or 'nothing'))
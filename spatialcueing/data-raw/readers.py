@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+""" Read subject files from any version of the spatial cueing experiment.
+
+The go/no-go files are tab-separated with blank cells, and the later
+versions write csv files with different names for some of the same
+columns. Readers here detect the delimiter from the header of each file,
+rename the columns to the names used by the current experiment, and give
+each known column the same type in every file. Files are read in chunks
+so that any number of subject files can be read without holding more than
+one chunk in memory.
+
+    for chunk in read_chunks('go-nogo/SPC401.tsv'):
+        ...
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas
+
+DELIMITERS = ['\t', ',']
+
+# Names of columns in older versions of the experiment
+ALIASES = {
+    'trial_ix': 'trial',
+    'cue_loc': 'cue_dir',
+    'response': 'response_type',
+    'interval': 'soa',
+}
+
+# Types of the columns in the current experiment. Other columns are read
+# as strings. Blank cells in float columns are missing values.
+INT_COLUMNS = ['block', 'trial', 'dropped_frames']
+FLOAT_COLUMNS = [
+    'soa',
+    'target_loc_x',
+    'target_loc_y',
+    'target_opacity',
+    'opacity_threshold',
+    'opacity_threshold_sd',
+    'measured_soa',
+    'fixation_ms',
+    'pre_cue_ms',
+    'cue_ms',
+    'interval_ms',
+    'target_ms',
+    'clear_ms',
+    'rt',
+    'is_correct',
+]
+
+Schema = namedtuple('Schema', 'delimiter names columns')
+
+
+def sniff(path, unlabeled=None):
+    """ Detect the delimiter and the columns of a subject file.
+
+    Parameters
+    ----------
+    path: The subject file.
+    unlabeled: Name for a last column that is missing from the header,
+        e.g., the interval in the SPC6 go/no-go files. It's only used if
+        the first row has one more field than the header. Defaults to
+        'unlabeled'.
+
+    Returns
+    -------
+    Schema with the delimiter, the names of the columns in the file, and
+    their names in the current experiment. None if the file is empty.
+    """
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\r\n')
+        first_row = f.readline().rstrip('\r\n')
+    if not header:
+        return None
+
+    delimiter = max(DELIMITERS, key=header.count)
+    names = header.split(delimiter)
+    if len(first_row.split(delimiter)) == len(names) + 1:
+        names.append(unlabeled or 'unlabeled')
+    columns = [ALIASES.get(name, name) for name in names]
+    return Schema(delimiter, names, columns)
+
+
+def _to_type(chunk, path):
+    """ Convert the known columns of a chunk of strings. """
+    for name in chunk.columns:
+        if name in FLOAT_COLUMNS:
+            values = chunk[name].replace('', np.nan)
+            chunk[name] = pandas.to_numeric(values).astype(float)
+        elif name in INT_COLUMNS:
+            if (chunk[name] == '').any():
+                raise ValueError('%s has blanks in %s' % (path, name))
+            chunk[name] = chunk[name].astype(int)
+    return chunk
+
+
+def read_chunks(path, chunksize=10000, unlabeled=None):
+    """ Yield the rows of a subject file as DataFrames of up to chunksize
+    rows, with the columns of the current experiment.
+
+    Empty files, or files with only a header, yield nothing.
+    """
+    schema = sniff(path, unlabeled)
+    if schema is None:
+        return
+    reader = pandas.read_csv(path, sep=schema.delimiter, header=0,
+                             names=schema.columns, dtype=str,
+                             keep_default_na=False, index_col=False,
+                             chunksize=chunksize)
+    for chunk in reader:
+        yield _to_type(chunk, path)
+
+
+def read_file(path, unlabeled=None):
+    """ Read a whole subject file. Returns an empty DataFrame with the
+    columns of the file if it has no rows. """
+    chunks = list(read_chunks(path, unlabeled=unlabeled))
+    if chunks:
+        return pandas.concat(chunks, ignore_index=True)
+    schema = sniff(path, unlabeled)
+    columns = schema.columns if schema is not None else []
+    return _to_type(pandas.DataFrame({name: pandas.Series([], dtype=str)
+                                      for name in columns},
+                                     columns=columns), path)
+
+
+def read_files(paths, chunksize=10000, unlabeled=None):
+    """ Yield (path, chunk) for the chunks of many subject files, one file
+    at a time. """
+    for path in paths:
+        for chunk in read_chunks(path, chunksize, unlabeled):
+            yield path, chunk
+
+
+def find_subject_files(directory, extensions=('.csv', '.tsv', '.txt')):
+    """ The subject files in a directory, sorted by name. """
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if os.path.splitext(name)[1] in extensions and
+            os.path.isfile(os.path.join(directory, name))]
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+
+import pandas
+import pytest
+
+import compiler
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def data_raw(tmpdir, monkeypatch):
+    """ A data-raw with one twomask subject file copied from the real one. """
+    twomask = tmpdir.mkdir('twomask')
+    shutil.copy(os.path.join(compiler.DATA_RAW, 'twomask', 'SPC101.csv'),
+                str(twomask))
+    monkeypatch.setattr(compiler, 'DATA_RAW', str(tmpdir))
+    monkeypatch.setattr(compiler, 'SOURCES', [
+        source for source in compiler.SOURCES if source.directory == 'twomask'
+    ])
+    monkeypatch.setattr(compiler, 'EXPERIMENTS', ['twomask'])
+    return tmpdir
+
+
+def _manifest(output_dir):
+    with open(os.path.join(output_dir, 'cache', compiler.MANIFEST)) as f:
+        return json.load(f)['files']
+
+
+def test_empty_subject_files_are_skipped(data_raw):
+    data_raw.join('twomask', 'SPC102.csv').write('')
+    output_dir = str(data_raw.join('compiled'))
+
+    with pytest.warns(UserWarning, match='twomask/SPC102.csv'):
+        assert compiler.compile_data(output_dir, processes=1) == ['twomask']
+
+    twomask = pandas.read_feather(os.path.join(output_dir, 'twomask.feather'))
+    assert set(twomask.subj_id) == {'SPC101'}
+    assert _manifest(output_dir)['twomask/SPC102.csv']['empty']
+
+    # The empty file is in the manifest, so nothing is rebuilt
+    assert compiler.compile_data(output_dir, processes=1) == []
+
+
+def test_files_that_fail_are_reported_and_the_rest_are_kept(data_raw):
+    data_raw.join('twomask', 'SPC102.csv').write('block,trial\nx,0\n')
+    output_dir = str(data_raw.join('compiled'))
+
+    with pytest.warns(UserWarning, match='twomask/SPC102.csv'):
+        compiler.compile_data(output_dir, processes=1)
+
+    files = _manifest(output_dir)
+    assert 'twomask/SPC101.csv' in files
+    assert 'twomask/SPC102.csv' not in files